@@ -1,22 +1,81 @@
 from flask import (
-    Flask, render_template, request, redirect, url_for, flash, send_file
+    Flask, render_template, request, redirect, url_for, flash, send_file, session
 )
 import os
-from core import database, label_printer, export_utils, user_utils, utils
+import hashlib
+from core import database, duplicates, label_printer, export_utils, user_utils, utils, importer, reports, metrics, jobs, compression
 import json
 from pathlib import Path
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 import io
 import datetime
-from flask import Response
+import click
+from flask import Response, stream_with_context, abort
 
 app = Flask(__name__)
 app.secret_key = "landlieben-secret"
 app.config["UPLOAD_FOLDER"] = "data"
 app.config["DB_PATH"] = os.path.join("data", "inventory.db")
+app.config["DB_BUSY_TIMEOUT_MS"] = int(os.environ.get("DB_BUSY_TIMEOUT_MS", 5000))
+# Log requests slower than this many milliseconds (0 = off)
+app.config["SLOW_REQUEST_MS"] = float(os.environ.get("SLOW_REQUEST_MS", 0))
+# Background jobs: pool size, queue limit, and from which size exports/labels run as a job
+app.config["JOB_WORKERS"] = int(os.environ.get("JOB_WORKERS", 2))
+app.config["JOB_MAX_PENDING"] = int(os.environ.get("JOB_MAX_PENDING", 10))
+app.config["JOB_EXPORT_MIN_ROWS"] = int(os.environ.get("JOB_EXPORT_MIN_ROWS", 5000))
+app.config["JOB_LABELS_MIN_COUNT"] = int(os.environ.get("JOB_LABELS_MIN_COUNT", 500))
+# Codes accepted by one JSON batch scan request (NDJSON streams are answered batch by batch)
+app.config["SCAN_BATCH_MAX_CODES"] = int(os.environ.get("SCAN_BATCH_MAX_CODES", 5000))
 login_manager = LoginManager(app)
 login_manager.login_view = "login"
-data_path = Path("./data/gemeinden.json")
+
+database.init_app(app)
+database.init_db()
+metrics.init_app(app)
+jobs.init_app(app)
+compression.init_app(app)
+
+# ---------------------------------------------------------
+# Conditional GET
+# ---------------------------------------------------------
+# Responses that only change when the inventory does carry a strong ETag
+# built from database.current_change_seq() (or one product's change_seq);
+# a client sending it back in If-None-Match gets a 304 without the page or
+# the query being produced. "no-cache" lets browsers keep the response but
+# makes them ask every time.
+
+# HTML pages also depend on the templates; their newest mtime changes with every deploy
+TEMPLATES_VERSION = max(
+    (p.stat().st_mtime_ns for p in Path(app.root_path, app.template_folder).glob("*.html")), default=0
+)
+
+
+def _etag(*parts):
+    raw = json.dumps(parts, sort_keys=True, default=str, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+
+def _page_etag(*parts):
+    """
+    ETag of an HTML page: the templates, the logged-in user (shown in the
+    navbar) and pending flash messages (a page showing them differs) are part of it.
+    """
+    return _etag(TEMPLATES_VERSION, current_user.get_id(), session.get("_flashes"), *parts)
+
+
+def _with_etag(response, etag):
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def _not_modified(etag):
+    """A 304 response if the client already holds `etag` (plain or compressed), else None."""
+    for variant in compression.etag_variants(etag):
+        if variant in request.if_none_match:
+            return _with_etag(Response(status=304), variant)
+    return None
+
 
 # ---------------------------------------------------------
 # Home page
@@ -39,11 +98,8 @@ class User(UserMixin):
 
 @login_manager.user_loader
 def load_user(user_id):
-    conn = database.get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, username, role FROM users WHERE id=?", (user_id,))
-    row = cur.fetchone()
-    conn.close()
+    # Cached per process (see user_utils.USER_CACHE_TTL), so requests don't query users
+    row = user_utils.get_user(user_id)
     return User(*row) if row else None
 
 @app.route("/login", methods=["GET", "POST"])
@@ -84,13 +140,7 @@ def verwaltung():
         form = request.form
 
         # --- Load abbreviation ---
-        with open(data_path, "r", encoding="utf-8") as f:
-            gdata = json.load(f)
-
-        abbr = (
-            gdata["Gemeinden"].get(form["gemeinde"])
-            or gdata["VGs"].get(form["gemeinde"])
-        )
+        abbr = database.get_gemeinde_abbr(form["gemeinde"])
 
         if not abbr:
             flash("Keine Abkürzung für die ausgewählte Gemeinde gefunden.", "danger")
@@ -100,7 +150,6 @@ def verwaltung():
         dt = datetime.date.today()
 
         purchase_date = form.get("bestellt_am") or dt.isoformat()
-        code = utils.generate_code(abbr, purchase_date)
 
         # ---------------- VAT + PRICE ----------------
         einzelpreis_netto = float(form.get("preis_netto") or 0) or None
@@ -125,7 +174,6 @@ def verwaltung():
 
         # ---------------- DATA DICT ----------------
         data = dict(
-            code=code,
             projekt=form.get("projekt"),
             gemeinde=gemeinde,
             einsatzort=form.get("einsatzort"),
@@ -162,7 +210,14 @@ def verwaltung():
             database.add_option("hersteller", form.get("hersteller"))
 
         # ---------------- SAVE PRODUCT ----------------
-        database.add_product_safe(**data)
+        # Same checks as the import; new entries are only warned about, not blocked
+        found = duplicates.find_duplicates([data]).get(0)
+        if found:
+            flash(f"Mögliches Duplikat: stimmt überein mit {duplicates.describe(found)}.", "warning")
+
+        # The code is reserved in the same transaction as the insert (committed by add_product_safe)
+        code = utils.generate_code(abbr, purchase_date)
+        database.add_product_safe(code=code, **data)
 
         label_text = f"Land-lieben: {gemeinde} - {data['projekt']}"
         #label_printer.make_pdf_label(code, label_text)
@@ -189,117 +244,208 @@ def verwaltung():
 # ---------------------------------------------------------
 @app.route("/tabelle")
 def tabelle():
-    products = database.get_all_products()
-    return render_template("tabelle.html", products=products)
+    # Rows are loaded page by page from /api/products, so the page itself does not depend on them
+    etag = _page_etag("tabelle")
+    cached = _not_modified(etag)
+    if cached:
+        return cached
+    return _with_etag(app.make_response(render_template(
+        "tabelle.html",
+        sortable=database.SORTABLE_COLUMNS,
+        label_profiles=label_printer.SHEET_PROFILES,
+    )), etag)
 
 from flask import jsonify, request
 
-@app.route("/save_table", methods=["POST"])
-def save_table():
-    data = request.get_json()
-    updates = data.get("updates", [])
 
-    conn = database.get_connection()
-    cur = conn.cursor()
+def _table_filters(source):
+    """
+    Collect the table page filters from query args or a JSON dict.
+    Prices are parsed here, so a bad one is answered before any query (or export stream) starts.
+    """
+    if not isinstance(source, dict):
+        raise ValueError("Ungültige Filter.")
+    keys = ("gemeinde", "projekt", "kategorie", "jahr",
+            "min_price", "max_price", "from_date", "to_date", "q")
+    filters = {k: source.get(k) for k in keys if source.get(k) not in (None, "")}
+    for key in ("min_price", "max_price"):
+        if key in filters:
+            try:
+                filters[key] = float(filters[key])
+            except (TypeError, ValueError):
+                raise ValueError(f"Ungültiger Preis im Filter: {filters[key]}")
+    return filters
+
+
+def _row_shape(args):
+    """columns= (comma separated) and preview= of the row APIs, as keyword arguments."""
+    columns = args.get("columns")
+    return {
+        "columns": [c for c in columns.split(",") if c] if columns else None,
+        "preview": args.get("preview") in ("1", "true"),
+    }
+
+
+@app.route("/api/products")
+@login_required
+def api_products():
+    args = request.args
+    etag = _etag("products", database.current_change_seq(), sorted(args.items(multi=True)))
+    cached = _not_modified(etag)
+    if cached:
+        return cached
+    try:
+        page = database.query_products(
+            filters=_table_filters(args),
+            sort=args.get("sort", "code"),
+            direction=args.get("dir", "asc"),
+            cursor=args.get("cursor"),
+            limit=args.get("limit", database.PAGE_SIZE, type=int),
+            **_row_shape(args),
+        )
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    return _with_etag(jsonify(page), etag)
 
-    changed = 0
 
-    for row in updates:
-        code = row.get("code")
-        if not code:
-            continue
+@app.route("/api/search")
+@login_required
+def api_search():
+    rows = database.search_products(
+        request.args.get("q", ""),
+        limit=request.args.get("limit", 20, type=int),
+    )
+    return jsonify({"rows": rows})
 
-        # Fetch current DB state
-        cur.execute("SELECT * FROM inventory WHERE code=?", (code,))
-        existing = cur.fetchone()
-        if not existing:
-            continue
 
-        # Build new values tuple (EXACT schema order except code & erstellt_von)
-        new_values = (
-            row.get("projekt"),
-            row.get("gemeinde"),
-            row.get("einsatzort"),
-            row.get("kategorie"),
-            row.get("produkt"),
-            row.get("produktdetails"),
-            row.get("serialnummer"),
-            row.get("kv_id"),
-            row.get("einzelpreis_netto"),
-            row.get("einzelpreis_brutto"),
-            row.get("mwst_satz"),
-            row.get("anzahl"),
-            row.get("elo_nummer"),
-            row.get("geliefert_am"),
-            row.get("lieferumfang"),
-            row.get("funktionspruefung"),
-            row.get("notiz"),
-            row.get("getestet_am"),
-            row.get("getestet_von"),
-            row.get("hersteller"),
-            row.get("anschaffungsjahr"),
-            row.get("bestellt_am"),
-            row.get("uebergeben_am"),
-            row.get("bemerkungen"),
-            current_user.username,  # geaendert_von
-            code
+@app.route("/api/products/rows", methods=["POST"])
+@login_required
+def api_product_rows():
+    """Current state of specific rows, e.g. after a save conflict or to open a long text."""
+    data = request.get_json() or {}
+    codes = data.get("codes", [])
+    try:
+        rows = database.get_products_by_codes(codes, columns=data.get("columns"))
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    return jsonify({"rows": [rows[c] for c in codes if c in rows]})
+
+
+@app.route("/api/products/versions", methods=["POST"])
+@login_required
+def api_product_versions():
+    """Cheap poll: row versions for the codes a client has loaded."""
+    codes = (request.get_json() or {}).get("codes", [])
+    return jsonify({"versions": database.get_versions(codes)})
+
+
+@app.route("/api/products/changes")
+@login_required
+def api_product_changes():
+    """Delta sync: rows written since the client's watermark (from the first page or the last sync)."""
+    since = request.args.get("since", type=int)
+    if since is None:
+        return jsonify({"message": "Parameter 'since' fehlt."}), 400
+    try:
+        changes = database.get_changed_products(
+            since, filters=_table_filters(request.args), **_row_shape(request.args)
         )
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    return jsonify(changes)
+
+
+@app.route("/api/products/filters")
+@login_required
+def api_product_filters():
+    etag = _etag("filters", database.current_change_seq())
+    return _not_modified(etag) or _with_etag(jsonify(database.get_filter_values()), etag)
+
+@app.route("/save_table", methods=["POST"])
+def save_table():
+    data = request.get_json()
+    updates = data.get("updates", [])
 
-        cur.execute("""
-            UPDATE inventory SET
-                projekt=?,
-                gemeinde=?,
-                einsatzort=?,
-                kategorie=?,
-                produkt=?,
-                produktdetails=?,
-                serialnummer=?,
-                kv_id=?,
-                einzelpreis_netto=?,
-                einzelpreis_brutto=?,
-                mwst_satz=?,
-                anzahl=?,
-                elo_nummer=?,
-                geliefert_am=?,
-                lieferumfang=?,
-                funktionspruefung=?,
-                notiz=?,
-                getestet_am=?,
-                getestet_von=?,
-                hersteller=?,
-                anschaffungsjahr=?,
-                bestellt_am=?,
-                uebergeben_am=?,
-                bemerkungen=?,
-                geaendert_von=?
-            WHERE code=?
-        """, new_values)
-
-        changed += 1
-
-    conn.commit()
-    conn.close()
-    return jsonify({"message": f"{changed} Zeile(n) aktualisiert."})
+    results = database.update_products(updates, current_user.username)
+
+    changed = sum(1 for r in results if r["status"] == "updated")
+    unchanged = sum(1 for r in results if r["status"] == "unchanged")
+    conflicts = [r["code"] for r in results if r["status"] == "conflict"]
+    invalid = sum(1 for r in results if r["status"] == "invalid")
+    not_found = sum(1 for r in results if r["status"] == "not_found")
+
+    message = f"{changed} Zeile(n) aktualisiert, {unchanged} unverändert."
+    if not_found:
+        message += f" {not_found} Zeile(n) nicht gefunden (inzwischen gelöscht?)."
+    if invalid:
+        message += f" {invalid} Zeile(n) ungültig und nicht gespeichert."
+    if conflicts:
+        message += (
+            f" {len(conflicts)} Zeile(n) wurden inzwischen von jemand anderem geändert"
+            " und nicht gespeichert."
+        )
+    return jsonify({"message": message, "results": results, "conflicts": conflicts})
 
 
 
 @app.route("/delete_rows", methods=["POST"])
+@login_required
 def delete_rows():
     data = request.get_json()
     ids = data.get("ids", [])
-    print(ids)
     if not ids:
         return jsonify({"message": "Keine IDs angegeben."})
 
-    conn = database.get_connection()
-    cur = conn.cursor()
-    for pid in ids:
-        cur.execute("DELETE FROM inventory WHERE code=?", (pid,))
-    conn.commit()
-    conn.close()
-    return jsonify({"message": f"{len(ids)} Zeile(n) gelöscht."})
+    # Soft delete: the rows are hidden everywhere and can be restored until purged
+    deleted = database.delete_products(ids, current_user.username)
+    return jsonify({"message": f"{deleted} Zeile(n) gelöscht.", "deleted": deleted})
+
+
+@app.route("/api/restore", methods=["POST"])
+@login_required
+def api_restore():
+    ids = (request.get_json() or {}).get("ids", [])
+    if not ids:
+        return jsonify({"message": "Keine IDs angegeben."}), 400
+    restored = database.restore_products(ids, current_user.username)
+    return jsonify({"message": f"{restored} Zeile(n) wiederhergestellt.", "restored": restored})
+
+
+@app.route("/api/deleted")
+@login_required
+def api_deleted():
+    """Recently deleted products that can still be restored."""
+    # get_deleted_products clamps the limit to 1..MAX_PAGE_SIZE
+    return jsonify(database.get_deleted_products(request.args.get("limit", database.PAGE_SIZE, type=int)))
+
+
+@app.route("/api/purge_deleted", methods=["POST"])
+@login_required
+def api_purge_deleted():
+    """Admins: archive and remove old tombstones in the background."""
+    if current_user.role != "admin":
+        abort(403)
+    data = request.get_json(silent=True) or {}
+    days = data.get("days", database.DELETED_RETENTION_DAYS)
+    # bool is an int in Python, but "days": true is no number of days
+    if not isinstance(days, int) or isinstance(days, bool) or not 0 <= days <= 3650:
+        return jsonify({"message": "'days' muss eine ganze Zahl zwischen 0 und 3650 sein."}), 400
+    return _submit_job("purge", {
+        "older_than_days": days,
+        "archive": bool(data.get("archive", True)),
+    })
+
+
+@app.cli.command("purge-deleted")
+@click.option("--days", type=int, default=None, help="Only tombstones older than this (default DELETED_RETENTION_DAYS).")
+@click.option("--no-archive", is_flag=True, help="Delete without copying to inventory_archive.")
+def purge_deleted_command(days, no_archive):
+    """Move deleted products past their retention to inventory_archive."""
+    purged = database.purge_deleted(days, archive=not no_archive)
+    click.echo(f"{purged} gelöschte Produkt(e) bereinigt.")
 
 @app.route("/print_selected", methods=["POST"])
+@login_required
 def print_selected():
     data = request.get_json()
     ids = data.get("ids", [])
@@ -307,41 +453,37 @@ def print_selected():
     if not ids:
         return jsonify({"message": "Keine IDs angegeben."})
 
-    conn = database.get_connection()
-    cur = conn.cursor()
+    # checked here, so a bad layout is answered before any job is queued
+    profile = data.get("profile", label_printer.DEFAULT_PROFILE)
+    try:
+        label_printer.sheet_profile(profile)
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    try:
+        start_offset = int(data.get("start_offset") or 0)
+    except (TypeError, ValueError):
+        return jsonify({"message": "Ungültige Startposition."}), 400
 
-    cur.execute(
-        f"SELECT * FROM inventory WHERE code IN ({','.join(['?'] * len(ids))})",
-        ids
-    )
-    rows = cur.fetchall()
-    conn.close()
-
-    if not rows:
-        return jsonify({"message": "Keine Produkte gefunden."})
-
-    output_dir = Path("data/temp_labels")
-    output_dir.mkdir(parents=True, exist_ok=True)
+    if data.get("background") or len(ids) >= app.config["JOB_LABELS_MIN_COUNT"]:
+        return _submit_job("labels", {"ids": ids, "profile": profile, "start_offset": start_offset})
 
-    pdf_paths = []
+    codes = database.existing_codes(ids)
 
-    for p in rows:
-        code = p[0]  # assuming code is first column
+    if not codes:
+        return jsonify({"message": "Keine Produkte gefunden."})
 
-        pdf_path = label_printer.make_pdf_label(
-            code_text=code,
-            output_dir=output_dir,
-            label_text=code  # 👈 important
+    # One PDF built in memory: no per-label files, no merge step, no shared output path
+    try:
+        pdf = label_printer.render_sheet(
+            ((code, code) for code in codes),
+            profile=profile,
+            start_offset=start_offset,
         )
-
-        pdf_paths.append(pdf_path)
-
-    # Merge into one PDF
-    final_pdf_path = output_dir / "merged_labels.pdf"
-    label_printer.merge_pdfs(pdf_paths, final_pdf_path)
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
 
     return send_file(
-        final_pdf_path,
+        pdf,
         mimetype="application/pdf",
         as_attachment=True,
         download_name="Etiketten_Landlieben.pdf"
@@ -350,9 +492,103 @@ def print_selected():
 
 
 
+# ---------------------------------------------------------
+# Metrics – request, SQL, PDF and export timings (Prometheus text format)
+# ---------------------------------------------------------
+@app.route("/metrics")
+@login_required
+def metrics_endpoint():
+    if current_user.role != "admin":
+        abort(403)
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+# ---------------------------------------------------------
+# Import – bulk CSV / Excel upload
+# ---------------------------------------------------------
+@app.route("/import", methods=["GET", "POST"])
+@login_required
+def import_upload():
+    mappings = database.get_import_mappings()
+
+    if request.method == "POST":
+        try:
+            token = importer.save_upload(request.files["file"])
+            header = importer.read_header(importer.upload_path(token))
+        except (KeyError, ValueError) as e:
+            flash(str(e) if isinstance(e, ValueError) else "Keine Datei ausgewählt.", "danger")
+            return redirect(url_for("import_upload"))
+
+        saved = mappings.get(request.form.get("mapping_name"), {})
+        return render_template(
+            "import.html",
+            step="mapping",
+            token=token,
+            mapping=importer.suggest_mapping(header, saved),
+            targets=importer.TARGET_COLUMNS,
+            gemeinden=database.get_all_gemeinden(),
+            mapping_name=request.form.get("mapping_name", ""),
+        )
+
+    return render_template("import.html", step="upload", mappings=mappings)
+
+
+@app.route("/import/run", methods=["POST"])
+@login_required
+def import_run():
+    form = request.form
+    try:
+        path = importer.upload_path(form["token"])
+    except ValueError as e:
+        flash(str(e), "danger")
+        return redirect(url_for("import_upload"))
+
+    # Mapping fields are named map::<source column>
+    mapping = {
+        key[len("map::"):]: value
+        for key, value in form.items()
+        if key.startswith("map::") and value
+    }
+    defaults = {
+        "projekt": form.get("projekt"),
+        "gemeinde": form.get("gemeinde"),
+        "bestellt_am": form.get("bestellt_am"),
+        "mwst_satz": form.get("mwst_satz"),
+    }
+
+    try:
+        result = importer.run_import(
+            path, mapping, current_user.username, defaults,
+            duplicate_policy=form.get("duplicates", "skip"),
+        )
+    finally:
+        path.unlink(missing_ok=True)
+
+    if form.get("save_mapping_as"):
+        database.save_import_mapping(form["save_mapping_as"].strip(), mapping)
+
+    flash(f"{result['inserted']} Produkt(e) importiert.", "success")
+    return render_template("import.html", step="result", result=result)
+
+
+
+
+@app.template_filter("euro")
+def euro(value):
+    """1234.5 -> '1.234,50 €'"""
+    return f"{value or 0:,.2f} €".replace(",", "X").replace(".", ",").replace("X", ".")
+
+
 @app.route("/berichte")
+@login_required
 def berichte():
-    return render_template("berichte.html")
+    # Totals come from the report_totals summary table, not from the inventory itself
+    return render_template(
+        "berichte.html",
+        totals=reports.get_totals(),
+        reports=reports.get_reports(),
+        dimensions=reports.DIMENSIONS,
+    )
 
 
 # ---------------------------------------------------------
@@ -361,46 +597,283 @@ def berichte():
 @app.route("/scan", methods=["GET", "POST"])
 def scan():
     item = None
-    if request.method == "POST":
-        code = request.form["code"].strip()
+    matches = []
+    code = request.form.get("code") if request.method == "POST" else request.args.get("code")
+    if code:
+        code = code.strip()
+
+    etag = None
+    if request.method == "GET":
+        # An exact code depends only on that product (its history included);
+        # anything else falls back to the search and so to the whole inventory
+        seq = database.get_product_change_seq(code) if code else None
+        etag = _page_etag("scan", code, seq if seq is not None else database.current_change_seq())
+        cached = _not_modified(etag)
+        if cached:
+            return cached
+
+    if code:
         item = database.get_product_by_code(code)
         if not item:
-            flash("Kein Produkt mit diesem Code gefunden.", "danger")
-        else:
+            # Not an exact code: fall back to the full-text index
+            matches = database.search_products(code, limit=20)
+            if len(matches) == 1:
+                item = database.get_product_by_code(matches[0]["code"])
+                matches = []
+        if item:
             flash("Produkt gefunden!", "success")
-    return render_template("scan.html", item=item)
+        elif matches:
+            flash(f"{len(matches)} mögliche Treffer gefunden.", "info")
+        else:
+            flash("Kein Produkt mit diesem Code gefunden.", "danger")
+    history = database.get_history(item["code"]) if item else []
+    response = app.make_response(render_template("scan.html", item=item, matches=matches, history=history))
+    return _with_etag(response, etag) if etag else response
+
+
+@app.route("/api/products/<code>/history")
+@login_required
+def api_product_history(code):
+    # get_history clamps the limit to 1..1000
+    return jsonify(database.get_history(code, request.args.get("limit", 100, type=int)))
+
+
+@app.route("/api/changes")
+@login_required
+def api_changes():
+    """Change log after ?cursor= (an entry id), oldest first; poll with the returned next_cursor."""
+    try:
+        page = database.get_changes(request.args.get("cursor", 0), request.args.get("limit", database.PAGE_SIZE))
+    except ValueError:
+        return jsonify({"message": "Ungültiger Cursor."}), 400
+    return jsonify(page)
+
+
+# ---------------------------------------------------------
+# Batch scan – many codes per request (inventory rounds)
+# ---------------------------------------------------------
+def _scan_result(code, row, update=None):
+    """Compact answer for one scanned code."""
+    if row is None:
+        result = {"code": code, "status": "unknown"}
+    else:
+        result = {k: v for k, v in row.items() if k != "deleted"}
+        result["status"] = "deleted" if row["deleted"] else "found"
+    if update is not None:
+        result["update"] = update["status"]
+    metrics.inc("scanned_codes_total", status=result["status"])
+    return result
+
+
+def _scanned_code(line):
+    """One NDJSON line: a JSON string, {"code": ...}, or the raw text a scanner typed."""
+    text = line.decode("utf-8", "replace").strip()
+    if not text:
+        return None
+    try:
+        value = json.loads(text)
+    except ValueError:
+        return text
+    if isinstance(value, dict):
+        value = value.get("code")
+    if value is None:
+        return None
+    return str(value).strip() or None
+
+
+def _scan_stream(lines):
+    """Resolve NDJSON codes one IN (...) query per batch and answer each batch as soon as it is read."""
+    batch, seen = [], set()
+
+    def flush():
+        found = database.scan_products(batch)
+        out = "".join(
+            json.dumps(_scan_result(code, found.get(code)), ensure_ascii=False, separators=(",", ":")) + "\n"
+            for code in batch
+        )
+        batch.clear()
+        return out
+
+    for line in lines:
+        code = _scanned_code(line)
+        if code is None or code in seen:  # scanned twice: answered once
+            continue
+        seen.add(code)
+        batch.append(code)
+        if len(batch) >= database.MAX_SQL_VARIABLES:
+            yield flush()
+    if batch:
+        yield flush()
+
+
+@app.route("/api/scan/batch", methods=["POST"])
+@login_required
+def api_scan_batch():
+    """
+    Resolve many scanned codes at once.
+    JSON {"codes": [...], "set": {column: value}}: answers {"results", "summary"};
+    with "set", the values are written to all found products in one transaction.
+    NDJSON (application/x-ndjson, one code per line): lookups only, answered
+    as NDJSON while the request body is still being read.
+    """
+    if request.mimetype == "application/x-ndjson":
+        return Response(stream_with_context(_scan_stream(request.stream)), mimetype="application/x-ndjson")
+
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data.get("codes"), list):
+        return jsonify({"message": "Liste 'codes' fehlt."}), 400
+    codes = list(dict.fromkeys(str(c).strip() for c in data["codes"] if str(c).strip()))
+    if len(codes) > app.config["SCAN_BATCH_MAX_CODES"]:
+        return jsonify({"message": f"Höchstens {app.config['SCAN_BATCH_MAX_CODES']} Codes pro Anfrage."}), 413
+
+    if data.get("set") is not None and not isinstance(data["set"], dict):
+        return jsonify({"message": "'set' muss ein Objekt {Spalte: Wert} sein."}), 400
+
+    updates = {}
+    if data.get("set"):
+        try:
+            results = database.bulk_update_products(codes, data["set"], current_user.username)
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
+        updates = {r["code"]: r for r in results}
+
+    # read after the update, so versions are the new ones
+    found = database.scan_products(codes)
+    results = [_scan_result(code, found.get(code), updates.get(code)) for code in codes]
+
+    summary = {status: 0 for status in ("found", "deleted", "unknown")}
+    for r in results:
+        summary[r["status"]] += 1
+    if updates:
+        summary["updated"] = sum(1 for r in updates.values() if r["status"] == "updated")
+    return jsonify({"results": results, "summary": summary})
 
 
 # ---------------------------------------------------------
-# Export – CSV download
+# Export – Excel / CSV download (streamed)
 # ---------------------------------------------------------
+def _export_response(rows, basename, fmt, key):
+    """
+    Send the export cached under `key` (see export_utils.export_key) if there
+    is one, else stream it from `rows` and cache it on the way.
+    """
+    if fmt == "csv":
+        mimetype, filename = "text/csv", f"{basename}.csv"
+    else:
+        mimetype = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        filename = f"{basename}.xlsx"
+
+    cached = export_utils.open_cached(key, fmt)
+    if cached:
+        response = send_file(cached, mimetype=mimetype, as_attachment=True, download_name=filename, etag=False)
+        return _with_etag(response, key)
+
+    body = export_utils.iter_csv(rows) if fmt == "csv" else export_utils.iter_xlsx(rows)
+    response = Response(
+        stream_with_context(export_utils.iter_cached(key, fmt, body)),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+    return _with_etag(response, key)
+
+
 @app.route("/export")
+@login_required
 def export_all():
-    rows = database.get_all_products()
-    path = export_utils.export_rows_to_excel(rows, "Inventar_Alle.xlsx")
-    return send_file(path, as_attachment=True)
+    fmt = request.args.get("format", "xlsx")
+    key = export_utils.export_key(fmt, {"all": True})
+    cached = _not_modified(key)
+    if cached:
+        return cached
+    return _export_response(database.iter_products(), "Inventar_Alle", fmt, key)
 
 
 @app.route("/export_filtered", methods=["POST"])
+@login_required
 def export_filtered():
     data = request.get_json()
     ids = data.get("ids", [])
-
-    if not ids:
+    fmt = data.get("format", "xlsx")
+
+    if "filters" in data:
+        # Export everything the table page currently matches, not just the loaded page
+        try:
+            filters = _table_filters(data["filters"])
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
+        sort, direction = data.get("sort", "code"), data.get("dir", "asc")
+        key = export_utils.export_key(fmt, {"filters": filters, "sort": sort, "dir": direction})
+        if data.get("background") or database.count_products(filters) >= app.config["JOB_EXPORT_MIN_ROWS"]:
+            return _submit_job("export", {
+                "filters": filters, "sort": sort, "dir": direction,
+                "format": fmt, "basename": "Inventar_Filtered",
+            })
+        rows = database.iter_products(filters=filters, sort=sort, direction=direction)
+    elif not ids:
         return "No data", 400
+    elif data.get("background") or len(ids) >= app.config["JOB_EXPORT_MIN_ROWS"]:
+        return _submit_job("export", {"codes": ids, "format": fmt, "basename": "Inventar_Filtered"})
+    else:
+        key = export_utils.export_key(fmt, {"codes": ids})
+        rows = database.iter_products(codes=ids)
+
+    return _export_response(rows, "Inventar_Filtered", fmt, key)
 
-    conn = database.get_connection()
-    cur = conn.cursor()
 
-    placeholders = ",".join(["?"] * len(ids))
-    query = f"SELECT * FROM inventory WHERE code IN ({placeholders})"
-    cur.execute(query, ids)
-    rows = cur.fetchall()
-    conn.close()
 
-    path = export_utils.export_rows_to_excel(rows, "Inventar_Filtered.xlsx")
 
-    return send_file(path, as_attachment=True)
+# ---------------------------------------------------------
+# Background jobs (large exports, label sheets, purges)
+# ---------------------------------------------------------
+def _submit_job(kind, params):
+    """Queue a job and answer 202 with the URLs to poll and to download from."""
+    try:
+        job_id = jobs.submit(kind, params, current_user.username)
+    except jobs.QueueFull as e:
+        return jsonify({"message": str(e)}), 503, {"Retry-After": "30"}
+    return jsonify({
+        "job_id": job_id,
+        "status_url": url_for("job_status", job_id=job_id),
+        "download_url": url_for("job_download", job_id=job_id),
+    }), 202
+
+
+def _own_job(job_id):
+    """The job, if it exists and belongs to the current user (admins see all)."""
+    job = jobs.get(job_id)
+    if job is None or (job["created_by"] != current_user.username and current_user.role != "admin"):
+        abort(404)
+    return job
+
+
+@app.route("/jobs/<job_id>")
+@login_required
+def job_status(job_id):
+    job = _own_job(job_id)
+    body = {
+        "job_id": job["id"],
+        "kind": job["kind"],
+        "status": job["status"],
+        "error": job["error"],
+        "filename": job["filename"],
+    }
+    if job["status"] == jobs.DONE and job["artifact"]:
+        body["download_url"] = url_for("job_download", job_id=job_id)
+    return jsonify(body)
+
+
+@app.route("/jobs/<job_id>/download")
+@login_required
+def job_download(job_id):
+    job = _own_job(job_id)
+    if job["status"] != jobs.DONE or not job["artifact"] or not os.path.exists(job["artifact"]):
+        return jsonify({"message": "Der Auftrag ist noch nicht fertig.", "status": job["status"]}), 409
+    return send_file(
+        os.path.abspath(job["artifact"]),
+        mimetype=job["mimetype"],
+        as_attachment=True,
+        download_name=job["filename"],
+    )
 
 
 
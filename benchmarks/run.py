@@ -0,0 +1,323 @@
+"""
+Benchmark the main endpoints against a synthetic inventory.
+
+    python -m benchmarks.run --rows 100000 --output bench-100k.json
+    python -m benchmarks.run --compare bench-before.json bench-after.json
+
+Everything runs in a temporary directory (database, labels, gemeinden.json),
+so the real ./data is never touched. Use --workdir to keep a generated
+database and reuse it for the next run.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+
+USER, PASSWORD = "bench", "bench"
+
+
+# -------------------- Scenarios --------------------
+# Each scenario gets the context and returns the number of items it handled
+# (rows, labels, codes); `setup` runs before every iteration and is not timed.
+
+def _json(response):
+    assert response.status_code == 200, (response.status_code, response.get_data(as_text=True)[:200])
+    return response.get_json()
+
+
+def _read(response):
+    assert response.status_code == 200, response.status_code
+    return len(response.get_data())
+
+
+def tabelle_page(ctx):
+    _read(ctx["client"].get("/tabelle"))
+    return 1
+
+
+def api_first_page(ctx):
+    return len(_json(ctx["client"].get("/api/products?limit=100"))["rows"])
+
+
+def api_deep_pages(ctx, pages=20):
+    rows, cursor = 0, None
+    for _ in range(pages):
+        url = "/api/products?limit=100&sort=einzelpreis_netto&dir=desc"
+        data = _json(ctx["client"].get(url + (f"&cursor={cursor}" if cursor else "")))
+        rows += len(data["rows"])
+        cursor = data["next_cursor"]
+        if not cursor:
+            break
+    return rows
+
+
+def api_filtered(ctx):
+    gemeinde = ctx["gemeinden"][0]
+    data = _json(ctx["client"].get("/api/products", query_string={
+        "gemeinde": gemeinde, "jahr": "2024", "sort": "geliefert_am", "dir": "desc", "limit": 100,
+    }))
+    return len(data["rows"])
+
+
+def api_search(ctx):
+    return len(_json(ctx["client"].get("/api/search?q=lapt"))["rows"])
+
+
+def _save_setup(ctx, count=50):
+    from core import database
+    codes = ctx["sample_codes"][:count]
+    rows = database.get_products_by_codes(codes)
+    ctx["updates"] = [
+        {"code": code, "version": rows[code]["version"],
+         "notiz": f"bench {time.time_ns()}", "anzahl": rows[code]["anzahl"] or 1}
+        for code in codes
+    ]
+
+
+def save_table(ctx):
+    data = _json(ctx["client"].post("/save_table", json={"updates": ctx["updates"]}))
+    return len(data["results"])
+
+
+def _clear_export_cache(ctx):
+    # without this every run after the first is answered from the export cache
+    from core import export_utils
+    shutil.rmtree(export_utils.EXPORT_CACHE_DIR, ignore_errors=True)
+
+
+def _fill_export_cache(ctx):
+    from core import export_utils
+    if not any(export_utils.EXPORT_CACHE_DIR.glob("*.csv")):
+        export_csv(ctx)
+
+
+def export_csv(ctx):
+    _read(ctx["client"].get("/export?format=csv"))
+    return ctx["rows"]
+
+
+def export_xlsx(ctx):
+    _read(ctx["client"].get("/export"))
+    return ctx["rows"]
+
+
+def print_selected(ctx, count=240):
+    _read(ctx["client"].post("/print_selected", json={
+        "ids": ctx["sample_codes"][:count], "profile": "a4_3x8",
+    }))
+    return count
+
+
+def generate_code(ctx, count=1000):
+    from core import database, utils
+    abbr = ctx["abbrs"][0]
+    with ctx["app"].app_context():
+        for _ in range(count):
+            with database.write_transaction():
+                utils.generate_code(abbr, "2025-06-15")
+    return count
+
+
+# name -> (function, setup, max iterations)
+SCENARIOS = {
+    "tabelle_page": (tabelle_page, None, None),
+    "api_first_page": (api_first_page, None, None),
+    "api_deep_pages": (api_deep_pages, None, None),
+    "api_filtered": (api_filtered, None, None),
+    "api_search": (api_search, None, None),
+    "save_table": (save_table, _save_setup, None),
+    "print_selected": (print_selected, None, None),
+    "generate_code": (generate_code, None, None),
+    "export_csv": (export_csv, _clear_export_cache, 2),
+    "export_xlsx": (export_xlsx, _clear_export_cache, 1),
+    # the same download while the inventory is unchanged: sent from the cached file
+    "export_csv_cached": (export_csv, _fill_export_cache, None),
+}
+
+
+def run_scenario(ctx, func, setup, iterations):
+    """Time `iterations` runs, then one more under tracemalloc for the Python peak memory."""
+    durations, items = [], 0
+    for _ in range(iterations):
+        if setup:
+            setup(ctx)
+        started = time.perf_counter()
+        items = func(ctx)
+        durations.append(time.perf_counter() - started)
+
+    if setup:
+        setup(ctx)
+    tracemalloc.start()
+    func(ctx)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    ordered = sorted(durations)
+    median = statistics.median(ordered)
+    return {
+        "iterations": iterations,
+        "items": items,
+        "latency_ms": {
+            "min": round(ordered[0] * 1000, 3),
+            "median": round(median * 1000, 3),
+            "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 3),
+            "max": round(ordered[-1] * 1000, 3),
+            "mean": round(statistics.fmean(ordered) * 1000, 3),
+        },
+        "throughput_per_s": round(items / median, 1) if median else None,
+        "peak_python_kib": round(peak / 1024),
+    }
+
+
+# -------------------- Setup --------------------
+
+def _git_revision():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO, text=True).strip()
+        dirty = bool(subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO, text=True).strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def prepare(workdir, rows, gemeinden_path, seed):
+    """chdir into `workdir`, write gemeinden.json and fill the database unless it already has `rows` rows."""
+    from benchmarks import synthetic
+
+    os.chdir(workdir)
+    Path("data").mkdir(exist_ok=True)
+    data = synthetic.SAMPLE_GEMEINDEN
+    if gemeinden_path:
+        data = json.loads(Path(gemeinden_path).read_text(encoding="utf-8"))
+    Path("data/gemeinden.json").write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+    gemeinden = synthetic.abbreviations(data)
+
+    from core import database
+    database.init_db()
+    conn = database.get_connection()
+    existing = conn.execute("SELECT COUNT(*) FROM inventory;").fetchone()[0]
+    generated_in = None
+    if existing != rows:
+        if existing:
+            raise SystemExit(f"{workdir} already holds {existing} rows; use another --workdir")
+        started = time.perf_counter()
+        synthetic.generate(rows, gemeinden, seed)
+        generated_in = round(time.perf_counter() - started, 2)
+    return gemeinden, generated_in
+
+
+def run(args):
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="inventory-bench-")).resolve()
+    workdir.mkdir(parents=True, exist_ok=True)
+    output = Path(args.output).resolve() if args.output else None
+    gemeinden_path = Path(args.gemeinden).resolve() if args.gemeinden else None
+
+    gemeinden, generated_in = prepare(workdir, args.rows, gemeinden_path, args.seed)
+
+    # The app opens ./data/inventory.db relative to the working directory
+    import app as app_module
+    from core import database, user_utils
+    app = app_module.app
+    app.config["TESTING"] = True
+    user_utils.add_user(USER, PASSWORD, "admin")
+
+    client = app.test_client()
+    response = client.post("/login", data={"username": USER, "password": PASSWORD})
+    assert response.status_code == 302, "login failed"
+
+    conn = database.get_connection()
+    step = max(1, args.rows // 500)
+    ctx = {
+        "app": app,
+        "client": client,
+        "rows": args.rows,
+        "gemeinden": list(gemeinden),
+        "abbrs": list(gemeinden.values()),
+        # spread over the whole table rather than the first codes only
+        "sample_codes": [r[0] for r in conn.execute(
+            f"SELECT code FROM inventory WHERE rowid % {step} = 0 ORDER BY rowid LIMIT 500;")],
+    }
+
+    selected = args.scenario or list(SCENARIOS)
+    results = {}
+    for name in selected:
+        func, setup, max_iterations = SCENARIOS[name]
+        iterations = min(args.repeat, max_iterations or args.repeat)
+        results[name] = run_scenario(ctx, func, setup, iterations)
+        print(f"{name:16} median {results[name]['latency_ms']['median']:>10.2f} ms", file=sys.stderr)
+
+    commit, dirty = _git_revision()
+    report = {
+        "meta": {
+            "commit": commit,
+            "dirty": dirty,
+            "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            "rows": args.rows,
+            "seed": args.seed,
+            "generate_seconds": generated_in,
+            "db_bytes": (workdir / "data" / "inventory.db").stat().st_size,
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+        },
+        "scenarios": results,
+        # whole process, Linux reports KiB
+        "max_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    text = json.dumps(report, indent=2)
+    if output:
+        output.write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+
+    if not args.workdir:
+        os.chdir(REPO)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(before_path, after_path):
+    """Print the median latency of every scenario in two result files and the change."""
+    before = json.loads(Path(before_path).read_text())
+    after = json.loads(Path(after_path).read_text())
+    print(f"{'scenario':16} {'before ms':>12} {'after ms':>12} {'change':>8}")
+    for name, result in after["scenarios"].items():
+        new = result["latency_ms"]["median"]
+        old = before["scenarios"].get(name, {}).get("latency_ms", {}).get("median")
+        change = f"{(new - old) / old * 100:+.1f}%" if old else "-"
+        print(f"{name:16} {old if old is not None else '-':>12} {new:>12} {change:>8}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10_000, help="inventory size, e.g. 10000, 100000, 1000000")
+    parser.add_argument("--repeat", type=int, default=5, help="timed iterations per scenario")
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS), help="run only these (repeatable)")
+    parser.add_argument("--gemeinden", help="gemeinden.json to spread rows over (default: built-in sample)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workdir", help="keep the generated database here and reuse it")
+    parser.add_argument("--output", help="write the JSON result here instead of stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two result files")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+    else:
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import datetime
+import random
+from collections import defaultdict
+
+from core import database, utils
+
+# Used when no gemeinden.json is given (abbreviations from the harmonization notebook)
+SAMPLE_GEMEINDEN = {
+    "Gemeinden": {
+        "St. Julian": "SJU",
+        "Quirnbach": "QUI",
+        "Langweiler": "LAN",
+        "Kappeln": "KAP",
+        "Hoppstädten": "HOP",
+        "Herschweiler-Pettersheim": "HPE",
+    },
+    "VGs": {"VG Kusel-Altenglan": "VGK", "VG Oberes Glantal": "VGO"},
+}
+
+# (produkt, hersteller choices, net price range, typical quantity, consumable)
+CATALOG = [
+    ("Laptop", ["Dell", "Lenovo", "HP", "Apple"], (650, 1900), 1, False),
+    ("Monitor", ["Dell", "Samsung", "LG", "iiyama"], (120, 450), 1, False),
+    ("Dockingstation", ["Dell", "Lenovo", "HP"], (90, 280), 1, False),
+    ("Tablet", ["Apple", "Samsung", "Lenovo"], (250, 1100), 1, False),
+    ("Smartphone", ["Apple", "Samsung", "Google"], (200, 950), 1, False),
+    ("Multifunktionsdrucker", ["Brother", "HP", "Canon", "Kyocera"], (180, 2400), 1, False),
+    ("Beamer", ["Epson", "BenQ", "Optoma"], (400, 1500), 1, False),
+    ("Router", ["AVM", "Cisco", "Ubiquiti"], (80, 650), 1, False),
+    ("Headset", ["Jabra", "Logitech", "Sennheiser"], (35, 220), 2, False),
+    ("Maus", ["Logitech", "Microsoft", "Cherry"], (12, 60), 5, False),
+    ("Tastatur", ["Logitech", "Cherry", "Microsoft"], (18, 90), 5, False),
+    ("Toner", ["Brother", "HP", "Kyocera"], (30, 140), 4, True),
+    ("HDMI-Kabel", ["Goobay", "Delock"], (4, 25), 10, True),
+]
+PROJEKTE = ["Digitale Dörfer", "Smart Village", "Schule digital", "Bürgerbüro", "Dorfladen", None]
+EINSATZORTE = ["Rathaus", "Grundschule", "Kita", "Feuerwehr", "Bürgerhaus", "Dorfgemeinschaftshaus", None]
+PERSONEN = ["cs", "jl", "lk", "mb"]
+
+COLUMNS = database.PRODUCT_COLUMNS
+
+
+def abbreviations(data):
+    """{name: abbreviation} from gemeinden.json content, with the app's precedence (Gemeinden over VGs)."""
+    names = dict(data["VGs"])
+    names.update(data["Gemeinden"])
+    return names
+
+
+def _date(rng, start, days):
+    return start + datetime.timedelta(days=rng.randrange(days))
+
+
+def iter_rows(count, gemeinden, seed=42, start=datetime.date(2023, 1, 1), days=3 * 365):
+    """
+    Yield `count` inventory rows (tuples in COLUMNS order) with a realistic mix:
+    skewed Gemeinde sizes, catalog prices, partial delivery/handover dates and
+    mostly unique serial numbers. Codes follow LL-ABR-YYMM-#### per Gemeinde and month.
+    """
+    rng = random.Random(seed)
+    names = list(gemeinden)
+    # a few Gemeinden own most of the inventory
+    weights = [1 / (i + 1) for i in range(len(names))]
+    counters = defaultdict(int)
+
+    for i in range(count):
+        gemeinde = rng.choices(names, weights)[0]
+        produkt, hersteller_choices, (low, high), qty, consumable = rng.choice(CATALOG)
+        bestellt = _date(rng, start, days)
+        yymm = bestellt.strftime("%y%m")
+        abbr = gemeinden[gemeinde]
+        counters[abbr, yymm] += 1
+
+        netto = round(rng.uniform(low, high), 2)
+        mwst = 19.0 if rng.random() > 0.05 else 7.0
+        netto, brutto = utils.calculate_prices(netto, None, mwst)
+        geliefert = bestellt + datetime.timedelta(days=rng.randrange(3, 60)) if rng.random() < 0.85 else None
+        uebergeben = geliefert + datetime.timedelta(days=rng.randrange(1, 90)) if geliefert and rng.random() < 0.7 else None
+        person = rng.choice(PERSONEN)
+
+        row = {
+            "code": utils.format_code(abbr, yymm, counters[abbr, yymm]),
+            "projekt": rng.choice(PROJEKTE),
+            "gemeinde": gemeinde,
+            "einsatzort": rng.choice(EINSATZORTE),
+            "kategorie": utils.assign_category(netto, consumable),
+            "produkt": f"{produkt} {rng.choice('ABCDEFGH')}{rng.randrange(100, 999)}",
+            "produktdetails": f"{produkt} für {gemeinde}, Lieferung {i % 97}" if rng.random() < 0.6 else None,
+            "serialnummer": f"SN{seed}{i:08d}" if rng.random() < 0.7 else None,
+            "kv_id": f"KV-{i:07d}" if rng.random() < 0.4 else None,
+            "einzelpreis_netto": netto,
+            "einzelpreis_brutto": brutto,
+            "mwst_satz": mwst,
+            "anzahl": qty if rng.random() < 0.8 else rng.randrange(1, 3 * qty + 1),
+            "elo_nummer": f"ELO{i:07d}" if rng.random() < 0.2 else None,
+            "geliefert_am": geliefert.isoformat() if geliefert else None,
+            "lieferumfang": "vollständig" if geliefert else None,
+            "funktionspruefung": "ok" if uebergeben else None,
+            "notiz": "Ersatzgerät" if rng.random() < 0.05 else None,
+            "getestet_am": uebergeben.isoformat() if uebergeben else None,
+            "getestet_von": person if uebergeben else None,
+            "hersteller": rng.choice(hersteller_choices),
+            "anschaffungsjahr": str(bestellt.year),
+            "bestellt_am": bestellt.isoformat(),
+            "uebergeben_am": uebergeben.isoformat() if uebergeben else None,
+            "bemerkungen": None,
+            "erstellt_von": person,
+            "geaendert_von": person,
+        }
+        yield tuple(row[c] for c in COLUMNS)
+
+
+def generate(count, gemeinden, seed=42, batch_size=50_000):
+    """Insert `count` synthetic rows through the app's own insert path (triggers included)."""
+    conn = database.get_connection()
+    rows = iter_rows(count, gemeinden, seed)
+    while True:
+        batch = [row for _, row in zip(range(batch_size), rows)]
+        if not batch:
+            break
+        with database.write_transaction(conn):
+            database.insert_products(batch, COLUMNS, conn)
@@ -0,0 +1,76 @@
+import gzip
+import os
+
+from flask import request
+
+from . import metrics
+
+try:
+    import brotli
+except ImportError:  # optional (see requirements.txt): without it responses are gzip-compressed only
+    brotli = None
+
+# Smaller bodies fit into a packet or two anyway
+MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", 1024))
+# Dynamic responses are compressed on every request: favour speed over the last percent
+GZIP_LEVEL = int(os.environ.get("COMPRESS_GZIP_LEVEL", 6))
+BROTLI_QUALITY = int(os.environ.get("COMPRESS_BROTLI_QUALITY", 5))
+
+COMPRESSIBLE = {"text/html", "application/json", "application/x-ndjson"}
+
+
+def encodings():
+    """Content codings this process can produce, preferred first."""
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def etag_variants(etag):
+    """
+    All ETags a response with `etag` may have been sent under: a compressed
+    body is another representation and gets its own tag (`etag-gzip`, ...).
+    """
+    return [etag] + [f"{etag}-{encoding}" for encoding in encodings()]
+
+
+def _compress(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    # mtime=0: the same body always compresses to the same bytes
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def _after_request(response):
+    if (
+        response.status_code < 200
+        or response.status_code in (204, 304)
+        or response.mimetype not in COMPRESSIBLE
+        # streamed bodies (exports) and files are sent as they are
+        or response.is_streamed
+        or response.direct_passthrough
+        or "Content-Encoding" in response.headers
+    ):
+        return response
+
+    # caches must keep the compressed and the plain variant apart
+    response.vary.add("Accept-Encoding")
+    encoding = request.accept_encodings.best_match(encodings())
+    if encoding is None:
+        return response
+    data = response.get_data()
+    if len(data) < MIN_BYTES:
+        return response
+
+    body = _compress(data, encoding)
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak)
+    metrics.inc("http_response_bytes_total", len(data), encoding="identity")
+    metrics.inc("http_response_bytes_total", len(body), encoding=encoding)
+    return response
+
+
+def init_app(app):
+    """Compress HTML and JSON responses of `app` for clients that accept it."""
+    app.after_request(_after_request)
@@ -1,16 +1,193 @@
 import sqlite3
 from pathlib import Path
+import base64
+import datetime
 import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+
+from . import metrics
 
 DB_PATH = Path("./data/inventory.db")
 DB_PATH.parent.mkdir(exist_ok=True)
 
+# Connection tuning; overridable through the environment or app.config (see init_app)
+BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", 5000))
+CACHE_SIZE_KIB = int(os.environ.get("DB_CACHE_SIZE_KIB", 20000))
+MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", 256 * 1024 * 1024))
+
+_local = threading.local()
+
+# Column order of the inventory table as shown and exported
+PRODUCT_COLUMNS = [
+    "code",
+    "projekt",
+    "gemeinde",
+    "einsatzort",
+    "kategorie",
+    "produkt",
+    "produktdetails",
+    "serialnummer",
+    "kv_id",
+    "einzelpreis_netto",
+    "einzelpreis_brutto",
+    "mwst_satz",
+    "anzahl",
+    "elo_nummer",
+    "geliefert_am",
+    "lieferumfang",
+    "funktionspruefung",
+    "notiz",
+    "getestet_am",
+    "getestet_von",
+    "hersteller",
+    "anschaffungsjahr",
+    "bestellt_am",
+    "uebergeben_am",
+    "bemerkungen",
+    "erstellt_von",
+    "geaendert_von",
+]
+
+# Columns the table view may sort by; each one is backed by an index (see create_indexes)
+SORTABLE_COLUMNS = [
+    "code",
+    "projekt",
+    "gemeinde",
+    "kategorie",
+    "produkt",
+    "einzelpreis_netto",
+    "geliefert_am",
+    "hersteller",
+    "anschaffungsjahr",
+    "bestellt_am",
+]
+
+# Columns returned by the JSON APIs: the product plus its row version
+ROW_COLUMNS = PRODUCT_COLUMNS + ["version"]
+
+# Free-text columns that can hold paragraphs; the table page asks for a preview
+# of them (see _projection) and loads the full text when a cell is opened
+LONG_TEXT_COLUMNS = ["produktdetails", "notiz", "bemerkungen"]
+TEXT_PREVIEW_CHARS = 40
+
+# Columns the table page may edit (code and erstellt_von are fixed, geaendert_von is stamped)
+EDITABLE_COLUMNS = [c for c in PRODUCT_COLUMNS if c not in ("code", "erstellt_von", "geaendert_von")]
+REAL_COLUMNS = {"einzelpreis_netto", "einzelpreis_brutto", "mwst_satz"}
+INTEGER_COLUMNS = {"kategorie", "anzahl"}
+
+# SQLite's default limit on host parameters is 999 on older builds
+MAX_SQL_VARIABLES = 500
+
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+# Text columns covered by the full-text index (inventory_fts)
+SEARCH_COLUMNS = [
+    "code",
+    "produkt",
+    "produktdetails",
+    "serialnummer",
+    "kv_id",
+    "elo_nummer",
+    "hersteller",
+    "notiz",
+    "bemerkungen",
+]
+
+# Identifiers that mark a product as the same device (exact, indexed lookups)
+DUPLICATE_ID_COLUMNS = ["serialnummer", "kv_id", "elo_nummer"]
+# Columns of the normalized blocking key for likely duplicates without identifiers
+MATCH_KEY_COLUMNS = ["produkt", "hersteller", "gemeinde", "bestellt_am"]
+
+# Deleted products stay in the table as tombstones (deleted_at set) until they
+# are purged; every read of current products includes this condition
+LIVE = "deleted_at IS NULL"
+# Tombstones older than this are moved to inventory_archive by purge_deleted()
+DELETED_RETENTION_DAYS = int(os.environ.get("DELETED_RETENTION_DAYS", 30))
+
+# A client further behind than this many changed rows reloads instead of syncing
+SYNC_MAX_CHANGES = 1000
+
 
 # -------------------- Core helpers --------------------
 
+def connect(path=None):
+    """Open a new, tuned SQLite connection. Most code should use get_connection()."""
+    # Instrumented: statements are counted and timed per request (see core/metrics.py)
+    conn = sqlite3.connect(path or DB_PATH, timeout=BUSY_TIMEOUT_MS / 1000, factory=metrics.InstrumentedConnection)
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS};")
+    # NORMAL is durable across application crashes in WAL mode, only an OS crash can lose the last commit
+    conn.execute("PRAGMA synchronous = NORMAL;")
+    conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KIB};")
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE};")
+    conn.execute("PRAGMA temp_store = MEMORY;")
+    return conn
+
+
 def get_connection():
-    """Open SQLite connection to the main inventory database."""
-    return sqlite3.connect(DB_PATH)
+    """
+    Return the shared SQLite connection for the current request, or for the
+    current thread outside of a request. Callers must not close it; request
+    connections are closed by close_connection() at teardown.
+    """
+    if has_app_context():
+        if "db_conn" not in g:
+            g.db_conn = connect()
+        return g.db_conn
+
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = connect()
+    return conn
+
+
+def close_connection(exc=None):
+    """Teardown handler: roll back anything left uncommitted and close the request connection."""
+    conn = g.pop("db_conn", None)
+    if conn is not None:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.close()
+
+
+def init_app(app):
+    """Read the DB settings from app.config and register the teardown handler."""
+    global DB_PATH, BUSY_TIMEOUT_MS
+    DB_PATH = Path(app.config.get("DB_PATH", DB_PATH))
+    BUSY_TIMEOUT_MS = int(app.config.get("DB_BUSY_TIMEOUT_MS", BUSY_TIMEOUT_MS))
+    app.teardown_appcontext(close_connection)
+
+
+@contextmanager
+def write_transaction(conn=None):
+    """
+    Run a block inside BEGIN IMMEDIATE ... COMMIT on the shared connection.
+    The write lock is taken up front, so rows read inside the block cannot
+    change before the block writes them.
+    """
+    conn = conn or get_connection()
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        yield conn
+    except Exception:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+
+def chunked(items, size=MAX_SQL_VARIABLES):
+    """Yield successive slices of `items` small enough for one IN (...) list."""
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
 
 def table_columns(conn, table):
@@ -21,37 +198,54 @@ def table_columns(conn, table):
 
 
 # -------------------- Schema management --------------------
+# The create_* helpers do not commit: core/migrations.py runs each step in
+# its own transaction and records it in PRAGMA user_version.
 
-def create_schema(conn):
-    """Create all tables if they do not exist."""
-    cur = conn.cursor()
+# Current inventory layout; migrations rebuild older tables into this shape
+INVENTORY_SCHEMA = [
+    ("code", "TEXT UNIQUE NOT NULL"),
+    ("projekt", "TEXT"),
+    ("gemeinde", "TEXT NOT NULL"),
+    ("einsatzort", "TEXT"),
+    ("kategorie", "INTEGER"),
+    ("produkt", "TEXT"),
+    ("produktdetails", "TEXT"),
+    ("serialnummer", "TEXT"),
+    ("kv_id", "TEXT"),
+    ("einzelpreis_netto", "REAL"),
+    ("einzelpreis_brutto", "REAL"),
+    ("mwst_satz", "REAL"),
+    ("anzahl", "INTEGER DEFAULT 1"),
+    ("elo_nummer", "TEXT"),
+    ("geliefert_am", "TEXT"),
+    ("lieferumfang", "TEXT"),
+    ("funktionspruefung", "TEXT"),
+    ("notiz", "TEXT"),
+    ("getestet_am", "TEXT"),
+    ("getestet_von", "TEXT"),
+    ("hersteller", "TEXT"),
+    ("anschaffungsjahr", "TEXT"),
+    ("bestellt_am", "TEXT"),
+    ("uebergeben_am", "TEXT"),
+    ("bemerkungen", "TEXT"),
+    ("erstellt_von", "TEXT"),
+    ("geaendert_von", "TEXT"),
+    ("version", "INTEGER NOT NULL DEFAULT 0"),
+    ("deleted_at", "TEXT"),
+    ("deleted_by", "TEXT"),
+    ("change_seq", "INTEGER NOT NULL DEFAULT 0"),
+]
 
-    # --- main products table ---
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS inventory (
-            code TEXT UNIQUE NOT NULL,
-            gemeinde TEXT NOT NULL,
-            einsatzort TEXT,
-            kategorie TEXT,
-            produkttyp TEXT,
-            produktdetails TEXT,
-            anzahl INTEGER DEFAULT 1,
-            hersteller TEXT,
-            lieferant TEXT,
-            shop_link TEXT,
-            preis_netto REAL,
-            preis_brutto REAL,
-            bezahlt TEXT,
-            bestellt_am TEXT,
-            geliefert_am TEXT,
-            uebergeben_am TEXT,
-            projekt TEXT,
-            bemerkungen TEXT
-        )
-    """)
 
-    # --- dropdown options table ---
-    cur.execute("""
+def create_inventory_table(conn, name="inventory", extra_columns=()):
+    """Create the products table (current layout plus `extra_columns`, kept as untyped columns)."""
+    defs = [f"{col} {decl}" for col, decl in INVENTORY_SCHEMA] + list(extra_columns)
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {name} (\n    " + ",\n    ".join(defs) + "\n)")
+
+
+def create_options_table(conn):
+    """Values of the dropdown fields (einsatzorte, hersteller, ...)."""
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS options (
             field TEXT NOT NULL,
             value TEXT NOT NULL,
@@ -59,7 +253,153 @@ def create_schema(conn):
         )
     """)
 
-    conn.commit()
+
+def create_schema(conn):
+    """Create the main tables if they do not exist."""
+    create_inventory_table(conn)
+    create_options_table(conn)
+
+
+def create_indexes(conn):
+    """Create the indexes used by filtering, sorting and keyset pagination."""
+    cur = conn.cursor()
+    for col in SORTABLE_COLUMNS:
+        # code already has its UNIQUE index
+        if col == "code":
+            continue
+        # (col, code) matches ORDER BY col, code so pages are read straight from the index.
+        # Partial: reads of current products carry exactly LIVE, so tombstones
+        # are never visited and counts/DISTINCT stay index-only
+        cur.execute(
+            f"CREATE INDEX IF NOT EXISTS idx_inventory_{col} ON inventory ({col}, code) WHERE {LIVE};"
+        )
+    # Only tombstones are indexed: the purge and the trash list read them, everything else skips them
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_inventory_deleted_at ON inventory (deleted_at) "
+        "WHERE deleted_at IS NOT NULL;"
+    )
+    # Not partial: tombstones are changes too (see "Change counter" below)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_inventory_change_seq ON inventory (change_seq);")
+
+def match_key_sql(alias=""):
+    """
+    SQL expression of the duplicate blocking key: lower case, without blanks and dashes.
+    Queries must use the same expression (any table alias) to hit idx_inventory_match_key.
+    """
+    parts = [
+        f"lower(replace(replace(trim(coalesce({alias}{col}, '')), ' ', ''), '-', ''))"
+        for col in MATCH_KEY_COLUMNS
+    ]
+    return " || '|' || ".join(parts)
+
+
+def create_duplicate_indexes(conn):
+    """Indexes for duplicate detection: one per identifier column plus the blocking key."""
+    cur = conn.cursor()
+    for col in DUPLICATE_ID_COLUMNS:
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_inventory_{col} ON inventory ({col});")
+    cur.execute(f"CREATE INDEX IF NOT EXISTS idx_inventory_match_key ON inventory ({match_key_sql()});")
+
+def create_search_index(conn):
+    """
+    Create the FTS5 index over the inventory text columns and the triggers
+    keeping it in sync. The index is external-content (rowid = inventory.rowid),
+    so it stores only the tokens, not a second copy of the text.
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT name FROM sqlite_master WHERE name='inventory_fts';")
+    exists = cur.fetchone() is not None
+
+    cols = ", ".join(SEARCH_COLUMNS)
+    new_cols = ", ".join(f"new.{c}" for c in SEARCH_COLUMNS)
+    old_cols = ", ".join(f"old.{c}" for c in SEARCH_COLUMNS)
+
+    cur.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS inventory_fts USING fts5(
+            {cols},
+            content='inventory',
+            content_rowid='rowid',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS inventory_fts_ai AFTER INSERT ON inventory BEGIN
+            INSERT INTO inventory_fts(rowid, {cols}) VALUES (new.rowid, {new_cols});
+        END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS inventory_fts_ad AFTER DELETE ON inventory BEGIN
+            INSERT INTO inventory_fts(inventory_fts, rowid, {cols}) VALUES ('delete', old.rowid, {old_cols});
+        END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS inventory_fts_au AFTER UPDATE OF {cols} ON inventory BEGIN
+            INSERT INTO inventory_fts(inventory_fts, rowid, {cols}) VALUES ('delete', old.rowid, {old_cols});
+            INSERT INTO inventory_fts(rowid, {cols}) VALUES (new.rowid, {new_cols});
+        END
+    """)
+
+    if not exists:
+        rebuild_search_index(conn)
+
+
+def rebuild_search_index(conn):
+    """Re-tokenize all inventory rows (needed after bulk copies that change rowids)."""
+    conn.execute("INSERT INTO inventory_fts(inventory_fts) VALUES ('rebuild');")
+
+def create_code_sequences(conn):
+    """Counter table for LL-ABR-YYMM-#### codes, one row per Gemeinde abbreviation and month."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS code_sequences (
+            abbr TEXT NOT NULL,
+            yymm TEXT NOT NULL,
+            last_seq INTEGER NOT NULL,
+            PRIMARY KEY (abbr, yymm)
+        ) WITHOUT ROWID
+    """)
+
+def create_import_mappings(conn):
+    """Saved column mappings of the bulk import (source header -> inventory column)."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS import_mappings (
+            name TEXT PRIMARY KEY,
+            mapping TEXT NOT NULL
+        )
+    """)
+
+def create_archive_table(conn):
+    """Purged products: the inventory layout plus the time of the purge."""
+    create_inventory_table(conn, "inventory_archive", extra_columns=["purged_at TEXT"])
+
+
+def create_audit_table(conn):
+    """Change history, one row per product and write (see "Change history" below)."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS audit_log (
+            id INTEGER PRIMARY KEY,
+            code TEXT NOT NULL,
+            changed_at TEXT NOT NULL,
+            changed_by TEXT,
+            action TEXT NOT NULL,
+            changes TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_audit_log_code ON audit_log (code, changed_at);")
+
+
+def create_sync_state(conn):
+    """Named counters of the change sync: change_seq and purged_seq (see "Change counter" below)."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sync_state (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+    conn.execute(
+        "INSERT OR IGNORE INTO sync_state (name, value) VALUES ('change_seq', 0), ('purged_seq', 0);"
+    )
+
 
 def create_users_table(conn):
     cur = conn.cursor()
@@ -71,108 +411,865 @@ def create_users_table(conn):
             role TEXT DEFAULT 'user'
         );
     """)
-    conn.commit()
 
 
-def migrate_old_schema(conn):
-    """If old 'products' schema exists, migrate to new one."""
+def init_db():
+    """Initialize the DB: bring the schema up to date (see core/migrations.py)."""
+    from . import migrations
+
+    # Own connection: this runs at import time, before gunicorn forks its workers
+    conn = connect()
+    # WAL lets readers work while a writer commits; the mode is stored in the DB file
+    conn.execute("PRAGMA journal_mode = WAL;")
+    migrations.migrate(conn)
+    conn.close()
+
+
+# -------------------- CRUD helpers --------------------
+
+def add_product_safe(**kwargs):
+    """Safely insert a product record into the database."""
+    conn = get_connection()
+    with conn:
+        kwargs["change_seq"] = _bump_change_seq(conn)
+        fields = ", ".join(kwargs.keys())
+        placeholders = ", ".join(["?"] * len(kwargs))
+        conn.execute(f"INSERT INTO inventory ({fields}) VALUES ({placeholders})", tuple(kwargs.values()))
+        _audit(conn, [(kwargs["code"], None)], kwargs.get("erstellt_von"), "create")
+
+
+def reserve_sequence(abbr, yymm, count=1, conn=None):
+    """
+    Claim `count` consecutive sequence numbers for (abbr, yymm) and return the last one.
+    Does not commit: the UPDATE takes the write lock, so the numbers stay
+    reserved by the caller's transaction and are released if it rolls back.
+    """
+    conn = conn or get_connection()
     cur = conn.cursor()
-    cols = table_columns(conn, "inventory")
-    if not cols:
-        return False
 
-    print("Old schema detected, migrating...")
-    cur.execute("ALTER TABLE inventory RENAME TO products_old;")
-    create_schema(conn)
+    # First use of a key: start after the highest existing code (read via the code index)
+    prefix = f"LL-{abbr}-{yymm}-"
+    cur.execute(
+        """
+        INSERT OR IGNORE INTO code_sequences (abbr, yymm, last_seq)
+        SELECT ?, ?, COALESCE(MAX(CAST(substr(code, ?) AS INTEGER)), 0) FROM (
+            SELECT code FROM inventory WHERE code >= ? AND code < ?
+            UNION ALL
+            SELECT code FROM inventory_archive WHERE code >= ? AND code < ?
+        );
+        """,
+        # '.' sorts right after '-', so this is exactly the codes starting with prefix;
+        # purged codes count too, a code is never handed out twice
+        (abbr, yymm, len(prefix) + 1, prefix, prefix[:-1] + ".", prefix, prefix[:-1] + "."),
+    )
+    cur.execute(
+        "UPDATE code_sequences SET last_seq = last_seq + ? WHERE abbr=? AND yymm=?;",
+        (count, abbr, yymm),
+    )
+    cur.execute("SELECT last_seq FROM code_sequences WHERE abbr=? AND yymm=?;", (abbr, yymm))
+    return cur.fetchone()[0]
 
-    # Copy overlapping fields
-    existing = table_columns(conn, "products_old")
-    common = [c for c in existing if c in ("code", "bemerkungen", "gemeinde")]
-    if common:
-        fields = ", ".join(common)
-        cur.execute(f"INSERT INTO inventory ({fields}) SELECT {fields} FROM products_old;")
 
-    conn.commit()
-    return True
+def insert_products(rows, columns, conn=None, username=None):
+    """
+    Insert many product rows (tuples in `columns` order) with one executemany
+    and log them as created (by `username`, else their erstellt_von). Does not commit.
+    """
+    conn = conn or get_connection()
+    rows = list(rows)
+    if not rows:
+        return
+    # the same for every row, so it goes into the statement instead of each tuple
+    seq = _bump_change_seq(conn)
+    conn.executemany(
+        f"INSERT INTO inventory ({', '.join(columns)}, change_seq) "
+        f"VALUES ({', '.join(['?'] * len(columns))}, {int(seq)});",
+        rows,
+    )
+    code_index = columns.index("code")
+    if username is None and "erstellt_von" in columns:
+        username = rows[0][columns.index("erstellt_von")] if rows else None
+    _audit(conn, [(row[code_index], None) for row in rows], username, "create")
 
 
-def init_db():
-    """Initialize DB and ensure all required tables exist."""
+def get_all_products():
+    """Return all product rows sorted by newest first."""
     conn = get_connection()
     cur = conn.cursor()
-    create_users_table(conn)
-    cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='inventory';")
-    if cur.fetchone():
-        # Products table exists — check for migration and ensure options table
-        cols = table_columns(conn, "inventory")
-        if len(cols) < 10:  # very old schema heuristic
-            migrate_old_schema(conn)
-        else:
-            # Ensure 'options' table exists even in existing DB
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS options (
-                    field TEXT NOT NULL,
-                    value TEXT NOT NULL,
-                    UNIQUE(field, value)
-                )
-            """)
-            conn.commit()
+    cur.execute(f"SELECT {', '.join(PRODUCT_COLUMNS)} FROM inventory WHERE {LIVE} ORDER BY code ASC;")
+    rows = cur.fetchall()
+    return rows
+
+
+def _projection(columns=None, preview=False, keep=()):
+    """
+    SELECT list and row builder for a subset of ROW_COLUMNS (None: all);
+    code and version are always part of it. With `preview`, LONG_TEXT_COLUMNS
+    (except those in `keep`) are cut to TEXT_PREVIEW_CHARS and each row lists
+    the cut ones under "truncated". Extra select items may follow the list.
+    """
+    if columns is None:
+        names = list(ROW_COLUMNS)
     else:
-        # Fresh DB
-        create_schema(conn)
+        unknown = [c for c in columns if c not in ROW_COLUMNS]
+        if unknown:
+            raise ValueError(f"Unbekannte Spalte(n): {', '.join(unknown)}")
+        names = list(dict.fromkeys(["code", "version", *keep, *columns]))
+    cut = [c for c in names if preview and c in LONG_TEXT_COLUMNS and c not in keep]
 
-    conn.close()
+    select = [f"substr({c}, 1, {TEXT_PREVIEW_CHARS})" if c in cut else c for c in names]
+    select += [f"length({c}) > {TEXT_PREVIEW_CHARS}" for c in cut]
 
+    def build(r):
+        row = dict(zip(names, r))
+        if preview:
+            flags = r[len(names):len(names) + len(cut)]
+            row["truncated"] = [c for c, long in zip(cut, flags) if long]
+        return row
 
-# -------------------- CRUD helpers --------------------
+    return ", ".join(select), build
+
+
+def get_products_by_codes(codes, conn=None, columns=None):
+    """Return {code: row dict} for the given codes, one IN (...) query per chunk."""
+    select, build = _projection(columns)
+    conn = conn or get_connection()
+    cur = conn.cursor()
+    result = {}
+    for chunk in chunked(set(codes)):
+        cur.execute(
+            f"SELECT {select} FROM inventory "
+            f"WHERE code IN ({','.join(['?'] * len(chunk))}) AND {LIVE};",
+            chunk,
+        )
+        for r in cur.fetchall():
+            result[r[0]] = build(r)
+    return result
+
+
+def coerce_value(col, value):
+    """Convert a value typed into the table page to what the column stores."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.strip()
+        if value == "":
+            return None
+    try:
+        if col in REAL_COLUMNS:
+            return float(str(value).replace(",", "."))
+        if col in INTEGER_COLUMNS:
+            return int(float(str(value).replace(",", ".")))
+    except ValueError:
+        pass  # keep unparsable input as typed, like the old full-row UPDATE did
+    return value
+
+
+def _same_value(old, new):
+    if old in (None, "") and new in (None, ""):
+        return True
+    if isinstance(old, (int, float)) and isinstance(new, (int, float)):
+        return float(old) == float(new)
+    return str(old) == str(new)
+
+
+def update_products(updates, username):
+    """
+    Apply table page edits in one transaction.
+    All affected rows are loaded with one query, compared column by column,
+    and only changed columns of changed rows are written (one executemany per
+    set of changed columns). Returns one result dict per submitted row, in
+    submission order (a code submitted twice gets one, at its last submission).
+
+    A row that carries a "version" is only written if it still has that
+    version in the DB; otherwise it is reported as a conflict and left as is.
+    Rows without a code or with a version that is not a number are reported as invalid.
+    """
+    latest = {}
+    results = []  # (submission index, result)
+    for index, row in enumerate(updates):
+        code = row.get("code") if isinstance(row, dict) else None
+        if not code or not isinstance(code, str):
+            results.append((index, {"code": None, "status": "invalid"}))
+            continue
+        latest[code] = (index, row)  # the same code twice: the last submission wins
 
-def add_product_safe(**kwargs):
-    """Safely insert a product record into the database."""
     conn = get_connection()
+    with write_transaction(conn):
+        existing = get_products_by_codes(latest.keys(), conn)
+
+        groups = {}
+        history = []
+        for code, (index, row) in latest.items():
+            current = existing.get(code)
+            if current is None:
+                results.append((index, {"code": code, "status": "not_found"}))
+                continue
+
+            expected = row.get("version")
+            try:
+                expected = None if expected in (None, "") else int(expected)
+            except (TypeError, ValueError):
+                results.append((index, {"code": code, "status": "invalid"}))
+                continue
+            if expected is not None and expected != current["version"]:
+                results.append((index, {"code": code, "status": "conflict", "version": current["version"]}))
+                continue
+
+            changed = {}
+            for col in EDITABLE_COLUMNS:
+                if col not in row:
+                    continue
+                new = coerce_value(col, row[col])
+                if not _same_value(current[col], new):
+                    changed[col] = new
+
+            if not changed:
+                results.append((index, {"code": code, "status": "unchanged", "version": current["version"]}))
+                continue
+
+            cols = tuple(changed)
+            groups.setdefault(cols, []).append(
+                [changed[c] for c in cols] + [username, code, current["version"]]
+            )
+            history.append((code, {c: [current[c], changed[c]] for c in cols}))
+            results.append((index, {
+                "code": code,
+                "status": "updated",
+                "columns": list(cols),
+                "version": current["version"] + 1,
+            }))
+
+        seq = _bump_change_seq(conn) if groups else None
+        for cols, params in groups.items():
+            assignments = ", ".join(f"{c}=?" for c in cols)
+            # The version guard is redundant under BEGIN IMMEDIATE but keeps the statement safe on its own
+            conn.executemany(
+                f"UPDATE inventory SET {assignments}, geaendert_von=?, version=version+1, change_seq={int(seq)} "
+                f"WHERE code=? AND version=? AND {LIVE}",
+                params,
+            )
+        _audit(conn, history, username, "update")
+
+    return [result for _, result in sorted(results, key=lambda r: r[0])]
+
+
+def get_versions(codes):
+    """Return {code: version} for the given codes; deleted codes are missing."""
+    conn = get_connection()
+    cur = conn.cursor()
+    versions = {}
+    for chunk in chunked(set(codes)):
+        cur.execute(
+            f"SELECT code, version FROM inventory WHERE code IN ({','.join(['?'] * len(chunk))}) AND {LIVE};",
+            chunk,
+        )
+        versions.update(cur.fetchall())
+    return versions
+
+
+def existing_codes(codes):
+    """The given codes that exist in the inventory, in the given order, without repeats."""
+    found = get_versions(codes)
+    return [c for c in dict.fromkeys(codes) if c in found]
+
+
+def _encode_cursor(value, code):
+    raw = json.dumps([value, code]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def _decode_cursor(cursor):
     try:
-        with conn:
-            fields = ", ".join(kwargs.keys())
-            placeholders = ", ".join(["?"] * len(kwargs))
-            conn.execute(f"INSERT INTO inventory ({fields}) VALUES ({placeholders})", tuple(kwargs.values()))
-    except Exception as e:
-        conn.rollback()
-        raise e
-    finally:
-        conn.close()
+        value, code = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception:
+        raise ValueError("Ungültiger Cursor.")
+    return value, code
 
 
-def get_all_products():
-    """Return all product rows sorted by newest first."""
+def _filter_clause(filters):
+    """Translate the table page filters into a WHERE fragment + parameters."""
+    filters = filters or {}
+    where, params = [LIVE], []
+
+    for key, col in (
+        ("gemeinde", "gemeinde"),
+        ("projekt", "projekt"),
+        ("kategorie", "kategorie"),
+        ("jahr", "anschaffungsjahr"),
+    ):
+        if filters.get(key):
+            where.append(f"{col} = ?")
+            params.append(filters[key])
+
+    if filters.get("min_price") not in (None, ""):
+        where.append("einzelpreis_netto >= ?")
+        params.append(float(filters["min_price"]))
+    if filters.get("max_price") not in (None, ""):
+        where.append("einzelpreis_netto <= ?")
+        params.append(float(filters["max_price"]))
+
+    # Rows without a delivery date are kept, like the old client-side filter did
+    if filters.get("from_date"):
+        where.append("(geliefert_am IS NULL OR geliefert_am = '' OR geliefert_am >= ?)")
+        params.append(filters["from_date"])
+    if filters.get("to_date"):
+        where.append("(geliefert_am IS NULL OR geliefert_am = '' OR geliefert_am <= ?)")
+        params.append(filters["to_date"])
+
+    match = fts_query(filters.get("q"))
+    if match:
+        where.append("rowid IN (SELECT rowid FROM inventory_fts WHERE inventory_fts MATCH ?)")
+        params.append(match)
+
+    return where, params
+
+
+def fts_query(text):
+    """
+    Turn free text from a search box into an FTS5 MATCH expression:
+    every word must match as a prefix ("lap del" finds "Laptop Dell").
+    Returns None for empty input.
+    """
+    if not text:
+        return None
+    terms = []
+    for word in text.split():
+        word = word.replace('"', "")
+        if word:
+            # Quoting keeps FTS syntax characters (-, :, *) literal
+            terms.append(f'"{word}"*')
+    return " ".join(terms) or None
+
+
+def search_products(text, limit=20):
+    """Ranked full-text search over the inventory; returns a list of dicts."""
+    match = fts_query(text)
+    if not match:
+        return []
+    limit = max(1, min(int(limit or 20), MAX_PAGE_SIZE))
+
+    cols = ", ".join(f"i.{c}" for c in ROW_COLUMNS)
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(
+        f"""
+        SELECT {cols}
+        FROM inventory_fts f
+        JOIN inventory i ON i.rowid = f.rowid
+        WHERE inventory_fts MATCH ? AND i.{LIVE}
+        ORDER BY f.rank
+        LIMIT ?;
+        """,
+        (match, limit),
+    )
+    rows = [dict(zip(ROW_COLUMNS, r)) for r in cur.fetchall()]
+    return rows
+
+
+def _keyset_clause(sort, descending, cursor):
+    """
+    WHERE fragment selecting the rows after `cursor` for ORDER BY sort, code.
+    SQLite sorts NULLs first, so they need their own branch.
+    """
+    value, code = _decode_cursor(cursor)
+    if sort == "code":
+        return ("code < ?" if descending else "code > ?"), [code]
+
+    if value is None:
+        if descending:
+            return f"({sort} IS NULL AND code < ?)", [code]
+        return f"(({sort} IS NULL AND code > ?) OR {sort} IS NOT NULL)", [code]
+
+    if descending:
+        return (
+            f"({sort} < ? OR ({sort} = ? AND code < ?) OR {sort} IS NULL)",
+            [value, value, code],
+        )
+    return f"({sort} > ? OR ({sort} = ? AND code > ?))", [value, value, code]
+
+
+def count_products(filters=None):
+    """Number of products matching the table page filters."""
+    where, params = _filter_clause(filters)
+    conn = get_connection()
+    if where == [LIVE]:
+        # Unfiltered: the trigger-maintained report total is exact and saves an index scan
+        row = conn.execute(
+            "SELECT positions FROM report_totals WHERE dimension='gesamt' AND key='';"
+        ).fetchone()
+        return row[0] if row else 0
+    sql = "SELECT COUNT(*) FROM inventory WHERE " + " AND ".join(where)
+    return conn.execute(sql, params).fetchone()[0]
+
+
+def query_products(filters=None, sort="code", direction="asc", cursor=None, limit=PAGE_SIZE,
+                   columns=None, preview=False):
+    """
+    Return one page of products as dicts, filtered and sorted in SQL.
+    Uses keyset pagination: pass the returned next_cursor to get the next page.
+    The first page also carries the watermark for get_changed_products().
+    `columns` limits the rows to those columns (plus code, version and the
+    sort column), `preview` shortens the long text ones (see _projection).
+    """
+    if sort not in SORTABLE_COLUMNS:
+        raise ValueError(f"Sortierung nach '{sort}' nicht möglich.")
+    descending = direction == "desc"
+    limit = max(1, min(int(limit or PAGE_SIZE), MAX_PAGE_SIZE))
+    # the cursor is built from the full sort value
+    select, build = _projection(columns, preview, keep=(sort,))
+
+    where, params = _filter_clause(filters)
+
+    total = None
+    conn = get_connection()
+    cur = conn.cursor()
+
+    watermark = None
+    if not cursor:
+        # Read before the rows: a write in between is sent again by the next sync, never lost
+        watermark = current_change_seq(conn)
+        # Only the first page pays for the count
+        total = count_products(filters)
+    else:
+        clause, cursor_params = _keyset_clause(sort, descending, cursor)
+        where.append(clause)
+        params = params + cursor_params
+
+    order = "DESC" if descending else "ASC"
+    sql = f"SELECT {select} FROM inventory"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    if sort == "code":
+        sql += f" ORDER BY code {order}"
+    else:
+        sql += f" ORDER BY {sort} {order}, code {order}"
+    sql += " LIMIT ?"
+
+    # Fetch one extra row to know whether another page exists
+    cur.execute(sql, params + [limit + 1])
+    rows = cur.fetchall()
+
+    has_more = len(rows) > limit
+    rows = [build(r) for r in rows[:limit]]
+
+    next_cursor = None
+    if has_more:
+        last = rows[-1]
+        next_cursor = _encode_cursor(last[sort], last["code"])
+
+    return {"rows": rows, "next_cursor": next_cursor, "has_more": has_more, "total": total, "watermark": watermark}
+
+
+def get_products_by_filters(filters=None, sort="code", direction="asc"):
+    """Return all product rows matching the table page filters (used by the export)."""
+    if sort not in SORTABLE_COLUMNS:
+        sort = "code"
+    order = "DESC" if direction == "desc" else "ASC"
+    where, params = _filter_clause(filters)
+
+    sql = f"SELECT {', '.join(PRODUCT_COLUMNS)} FROM inventory"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {sort} {order}, code {order}"
+
     conn = get_connection()
     cur = conn.cursor()
-    cur.execute("SELECT * FROM inventory ORDER BY code ASC;")
+    cur.execute(sql, params)
     rows = cur.fetchall()
-    conn.close()
     return rows
 
 
+def iter_products(filters=None, codes=None, sort="code", direction="asc", batch_size=1000):
+    """
+    Yield product rows (PRODUCT_COLUMNS order) batch by batch with fetchmany,
+    so exports never hold the whole table in memory. Either `codes` or the
+    table page `filters` select the rows; neither means everything.
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    select = f"SELECT {', '.join(PRODUCT_COLUMNS)} FROM inventory"
+
+    if codes is not None:
+        for chunk in chunked(codes):
+            cur.execute(
+                f"{select} WHERE code IN ({','.join(['?'] * len(chunk))}) AND {LIVE} ORDER BY code;",
+                chunk,
+            )
+            yield from cur.fetchall()
+        return
+
+    if sort not in SORTABLE_COLUMNS:
+        sort = "code"
+    order = "DESC" if direction == "desc" else "ASC"
+    where, params = _filter_clause(filters)
+    sql = select
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {sort} {order}, code {order}"
+
+    cur.execute(sql, params)
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            break
+        yield from rows
+
+
+def get_filter_values():
+    """Distinct values for the table page filter dropdowns (read from the indexes)."""
+    conn = get_connection()
+    cur = conn.cursor()
+    values = {}
+    for key, col in (
+        ("gemeinde", "gemeinde"),
+        ("projekt", "projekt"),
+        ("kategorie", "kategorie"),
+        ("jahr", "anschaffungsjahr"),
+    ):
+        cur.execute(
+            f"SELECT DISTINCT {col} FROM inventory "
+            f"WHERE {col} IS NOT NULL AND {col} != '' AND {LIVE} ORDER BY {col};"
+        )
+        values[key] = [r[0] for r in cur.fetchall()]
+    return values
+
+
 def get_product_by_code(code):
     """Return one product row by its barcode/code as dictionary-like object."""
     conn = get_connection()
-    conn.row_factory = sqlite3.Row   # 👈 THIS IS THE MAGIC LINE
     cur = conn.cursor()
+    cur.row_factory = sqlite3.Row  # only this cursor, the connection is shared
 
-    cur.execute("SELECT * FROM inventory WHERE code=?;", (code,))
+    cur.execute(f"SELECT * FROM inventory WHERE code=? AND {LIVE};", (code,))
     row = cur.fetchone()
 
-    conn.close()
     return row
 
 
+# -------------------- Batch scan --------------------
+
+# What a scan answers with per code: enough to recognise the item on screen
+SCAN_COLUMNS = ["code", "produkt", "gemeinde", "einsatzort", "version"]
+# Fields an inventory round may set on all scanned items at once
+BULK_UPDATE_COLUMNS = ["einsatzort", "uebergeben_am", "funktionspruefung", "getestet_am", "getestet_von"]
+
+
+def scan_products(codes, conn=None):
+    """
+    Resolve scanned codes with one IN (...) query per chunk. Returns
+    {code: dict of SCAN_COLUMNS plus "deleted"} for every code in the table,
+    tombstones included (flagged), so a deleted item that turns up can be told
+    from an unknown code; unknown codes are missing.
+    """
+    conn = conn or get_connection()
+    found = {}
+    for chunk in chunked(dict.fromkeys(codes)):
+        cur = conn.execute(
+            f"SELECT {', '.join(SCAN_COLUMNS)}, deleted_at IS NOT NULL FROM inventory "
+            f"WHERE code IN ({','.join(['?'] * len(chunk))});",
+            chunk,
+        )
+        for r in cur.fetchall():
+            found[r[0]] = {**dict(zip(SCAN_COLUMNS, r)), "deleted": bool(r[-1])}
+    return found
+
+
+def bulk_update_products(codes, values, username):
+    """
+    Write the same `values` ({column: value}, BULK_UPDATE_COLUMNS only) to all
+    given products in one transaction, through update_products(): only real
+    changes are written, versioned and logged. Returns its per-code results.
+    """
+    if not isinstance(values, dict) or not values:
+        raise ValueError("Keine Werte zum Setzen angegeben.")
+    refused = [c for c in values if c not in BULK_UPDATE_COLUMNS]
+    if refused:
+        raise ValueError(f"Sammeländerung nicht möglich für: {', '.join(refused)}")
+    return update_products([{"code": code, **values} for code in dict.fromkeys(codes)], username)
+
+
+# -------------------- Soft delete --------------------
+
+def _now():
+    return datetime.datetime.now().isoformat(sep=" ", timespec="seconds")
+
+
+def delete_products(codes, username):
+    """
+    Mark products as deleted with one UPDATE per chunk of codes. They vanish
+    from every read but keep their data and code until purged.
+    Returns the number of products deleted.
+    """
+    conn = get_connection()
+    deleted = 0
+    with write_transaction(conn):
+        now = _now()
+        seq = _bump_change_seq(conn)
+        for chunk in chunked(list(dict.fromkeys(codes))):
+            done = conn.execute(
+                f"UPDATE inventory SET deleted_at=?, deleted_by=?, version=version+1, change_seq=? "
+                f"WHERE code IN ({','.join(['?'] * len(chunk))}) AND {LIVE} RETURNING code;",
+                [now, username, seq, *chunk],
+            ).fetchall()
+            _audit(conn, [(code, None) for code, in done], username, "delete", now)
+            deleted += len(done)
+    return deleted
+
+
+def restore_products(codes, username):
+    """Undo delete_products() for products that are not purged yet. Returns the number restored."""
+    conn = get_connection()
+    restored = 0
+    with write_transaction(conn):
+        seq = _bump_change_seq(conn)
+        for chunk in chunked(list(dict.fromkeys(codes))):
+            done = conn.execute(
+                f"UPDATE inventory SET deleted_at=NULL, deleted_by=NULL, geaendert_von=?, "
+                f"version=version+1, change_seq=? "
+                f"WHERE code IN ({','.join(['?'] * len(chunk))}) AND deleted_at IS NOT NULL RETURNING code;",
+                [username, seq, *chunk],
+            ).fetchall()
+            _audit(conn, [(code, None) for code, in done], username, "restore")
+            restored += len(done)
+    return restored
+
+
+def get_deleted_products(limit=PAGE_SIZE):
+    """The most recently deleted products (newest first) as dicts, read from idx_inventory_deleted_at."""
+    limit = max(1, min(int(limit or PAGE_SIZE), MAX_PAGE_SIZE))
+    columns = ["code", "produkt", "gemeinde", "deleted_at", "deleted_by"]
+    cur = get_connection().execute(
+        f"SELECT {', '.join(columns)} FROM inventory WHERE deleted_at IS NOT NULL "
+        f"ORDER BY deleted_at DESC LIMIT ?;",
+        (limit,),
+    )
+    return [dict(zip(columns, r)) for r in cur.fetchall()]
+
+
+def purge_deleted(older_than_days=None, archive=True, batch_size=MAX_SQL_VARIABLES - 1, conn=None):
+    """
+    Remove tombstones deleted more than `older_than_days` ago, copying them to
+    inventory_archive first unless archive=False. Works in batches, each in
+    its own write transaction, so the lock is never held for long.
+    Returns the number of products purged.
+    """
+    conn = conn or get_connection()
+    if older_than_days is None:
+        older_than_days = DELETED_RETENTION_DAYS
+    cutoff = (datetime.datetime.now() - datetime.timedelta(days=older_than_days)).isoformat(sep=" ", timespec="seconds")
+    # the archive may lag behind the inventory layout; copy what both have
+    archived = set(table_columns(conn, "inventory_archive"))
+    cols = ", ".join(c for c in table_columns(conn, "inventory") if c in archived)
+
+    purged = 0
+    while True:
+        with write_transaction(conn):
+            found = conn.execute(
+                "SELECT rowid, code FROM inventory WHERE deleted_at IS NOT NULL AND deleted_at < ? LIMIT ?;",
+                (cutoff, batch_size),
+            ).fetchall()
+            if not found:
+                break
+            rowids = [rowid for rowid, _ in found]
+            marks = ",".join(["?"] * len(rowids))
+            # clients that have not seen these tombstones yet can no longer sync
+            conn.execute(
+                f"UPDATE sync_state SET value = MAX(value, "
+                f"(SELECT MAX(change_seq) FROM inventory WHERE rowid IN ({marks}))) WHERE name='purged_seq';",
+                rowids,
+            )
+            if archive:
+                conn.execute(
+                    f"INSERT OR REPLACE INTO inventory_archive ({cols}, purged_at) "
+                    f"SELECT {cols}, ? FROM inventory WHERE rowid IN ({marks});",
+                    [_now(), *rowids],
+                )
+            conn.execute(f"DELETE FROM inventory WHERE rowid IN ({marks});", rowids)
+            _audit(conn, [(code, None) for _, code in found], None, "purge")
+        purged += len(rowids)
+    return purged
+
+
+# -------------------- Change counter --------------------
+# Every write transaction on inventory takes the next value of one global
+# counter and stamps it into change_seq of all rows it inserts, updates,
+# deletes or restores. Writers hold the write lock while they bump it, so
+# values become visible in increasing order: a client that remembers the
+# highest value it has seen (its watermark) gets exactly the rows written
+# since with one range scan of idx_inventory_change_seq.
+# Purged rows leave no trace; purged_seq is the newest change_seq that was
+# purged, and clients with an older watermark must reload.
+
+def _bump_change_seq(conn):
+    """Take the next change_seq. Must run inside the caller's write transaction."""
+    return conn.execute(
+        "UPDATE sync_state SET value = value + 1 WHERE name='change_seq' RETURNING value;"
+    ).fetchone()[0]
+
+
+def current_change_seq(conn=None):
+    """The newest change_seq handed out (0 on a database without writes)."""
+    conn = conn or get_connection()
+    row = conn.execute("SELECT value FROM sync_state WHERE name='change_seq';").fetchone()
+    return row[0] if row else 0
+
+
+def get_product_change_seq(code):
+    """change_seq of one current product (its last write), or None for unknown and deleted codes."""
+    row = get_connection().execute(
+        f"SELECT change_seq FROM inventory WHERE code=? AND {LIVE};", (code,)
+    ).fetchone()
+    return row[0] if row else None
+
+
+def get_changed_products(since, filters=None, limit=SYNC_MAX_CHANGES, columns=None, preview=False):
+    """
+    Rows written after the watermark `since`, split by the table page
+    filters: "rows" (dicts) are current products matching them, "removed"
+    are the codes of tombstones and of rows that no longer match.
+    "reset" is set instead when the client cannot catch up (more than
+    `limit` changes, or tombstones it never saw were purged).
+    `columns` and `preview` shape the rows like query_products() does.
+    """
+    since = int(since)
+    select, build = _projection(columns, preview)
+    where, params = _filter_clause(filters)
+    conn = get_connection()
+    cur = conn.cursor()
+    state = dict(cur.execute("SELECT name, value FROM sync_state;").fetchall())
+    if since < state.get("purged_seq", 0) or since > state.get("change_seq", 0):
+        return {"reset": True, "watermark": state.get("change_seq", 0)}
+
+    # LIVE is the first condition, so tombstones land in "removed" too
+    cur.execute(
+        f"SELECT {select}, change_seq, CASE WHEN {' AND '.join(where)} THEN 1 ELSE 0 END "
+        f"FROM inventory WHERE change_seq > ? ORDER BY change_seq LIMIT ?;",
+        params + [since, limit + 1],
+    )
+    changed = cur.fetchall()
+    if len(changed) > limit:
+        return {"reset": True, "watermark": state["change_seq"]}
+
+    rows, removed = [], []
+    for r in changed:
+        if r[-1]:
+            rows.append(build(r))
+        else:
+            removed.append(r[0])
+    return {
+        "reset": False,
+        "watermark": changed[-1][-2] if changed else since,
+        "rows": rows,
+        "removed": removed,
+        # the count only moves when something changed
+        "total": count_products(filters) if changed else None,
+    }
+
+
+# -------------------- Change history --------------------
+# Every write path logs what it did to audit_log in its own transaction, with
+# one executemany per batch. Updates keep only the changed columns as
+# {column: [old, new]}; the other actions (create, delete, restore, purge)
+# need no payload. The id increases with every entry and is the cursor of
+# get_changes().
+
+def _audit(conn, entries, username, action, at=None):
+    """Log (code, changes or None) pairs. Does not commit."""
+    at = at or _now()
+    conn.executemany(
+        "INSERT INTO audit_log (code, changed_at, changed_by, action, changes) VALUES (?, ?, ?, ?, ?);",
+        [
+            (code, at, username, action,
+             json.dumps(changes, ensure_ascii=False, separators=(",", ":")) if changes else None)
+            for code, changes in entries
+        ],
+    )
+
+
+AUDIT_COLUMNS = ["id", "code", "changed_at", "changed_by", "action", "changes"]
+
+
+def _audit_entry(row):
+    entry = dict(zip(AUDIT_COLUMNS, row))
+    entry["changes"] = json.loads(entry["changes"]) if entry["changes"] else {}
+    return entry
+
+
+def get_history(code, limit=100):
+    """The newest `limit` log entries of one product (1 to 1000), newest first."""
+    # a negative LIMIT means no limit to SQLite
+    limit = max(1, min(int(limit or 100), 1000))
+    cur = get_connection().execute(
+        f"SELECT {', '.join(AUDIT_COLUMNS)} FROM audit_log WHERE code=? "
+        f"ORDER BY changed_at DESC, id DESC LIMIT ?;",
+        (code, limit),
+    )
+    return [_audit_entry(r) for r in cur.fetchall()]
+
+
+def get_changes(cursor=0, limit=PAGE_SIZE):
+    """Log entries after `cursor` (an entry id), oldest first, with the cursor for the next call."""
+    limit = max(1, min(int(limit or PAGE_SIZE), MAX_PAGE_SIZE))
+    cur = get_connection().execute(
+        f"SELECT {', '.join(AUDIT_COLUMNS)} FROM audit_log WHERE id > ? ORDER BY id LIMIT ?;",
+        (int(cursor or 0), limit + 1),
+    )
+    rows = cur.fetchall()
+    entries = [_audit_entry(r) for r in rows[:limit]]
+    return {
+        "changes": entries,
+        "next_cursor": entries[-1]["id"] if entries else int(cursor or 0),
+        "has_more": len(rows) > limit,
+    }
+
+
+# -------------------- Import mappings --------------------
+
+def get_import_mappings():
+    """Return {name: {source column: inventory column}} of all saved mappings."""
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT name, mapping FROM import_mappings ORDER BY name COLLATE NOCASE;")
+    return {name: json.loads(mapping) for name, mapping in cur.fetchall()}
+
+
+def save_import_mapping(name, mapping):
+    conn = get_connection()
+    conn.execute(
+        "INSERT OR REPLACE INTO import_mappings (name, mapping) VALUES (?, ?);",
+        (name, json.dumps(mapping, ensure_ascii=False)),
+    )
+    conn.commit()
+
+
 # -------------------- Dropdown Options --------------------
+#
+# Options and the Gemeinde list are cached per process. Options are
+# invalidated when add_option inserts a value; the TTL bounds how long a
+# value added through another gunicorn worker stays invisible here.
+
+GEMEINDEN_PATH = Path("./data/gemeinden.json")
+GEMEINDEN_CHECK_INTERVAL = 5   # seconds between mtime checks of gemeinden.json
+OPTIONS_TTL = 60               # seconds
+
+_cache_lock = threading.Lock()
+_options_cache = {}            # field -> (loaded_at, [values])
+_gemeinden_cache = {"mtime": None, "checked_at": 0.0, "names": [], "abbr": {}}
+
 
 def get_options(field):
     """Return all saved dropdown options for a given field name."""
+    cached = _options_cache.get(field)
+    if cached and time.monotonic() - cached[0] < OPTIONS_TTL:
+        return cached[1]
+
     conn = get_connection()
     cur = conn.cursor()
     cur.execute("SELECT value FROM options WHERE field=? ORDER BY value COLLATE NOCASE;", (field,))
     values = [r[0] for r in cur.fetchall()]
-    conn.close()
+    with _cache_lock:
+        _options_cache[field] = (time.monotonic(), values)
     return values
 
 
@@ -180,15 +1277,43 @@ def add_option(field, value):
     """Add a new dropdown option if it does not exist."""
     if not value or not value.strip():
         return
+    value = value.strip()
+    if value in get_options(field):
+        return  # already known, no write needed
     conn = get_connection()
     cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO options(field, value) VALUES (?, ?);", (field, value.strip()))
+    cur.execute("INSERT OR IGNORE INTO options(field, value) VALUES (?, ?);", (field, value))
     conn.commit()
-    conn.close()
+    with _cache_lock:
+        _options_cache.pop(field, None)
+
+
+def _gemeinden():
+    """Parsed gemeinden.json, reloaded when the file's mtime changes."""
+    cache = _gemeinden_cache
+    now = time.monotonic()
+    if cache["mtime"] is not None and now - cache["checked_at"] < GEMEINDEN_CHECK_INTERVAL:
+        return cache
+
+    with _cache_lock:
+        mtime = GEMEINDEN_PATH.stat().st_mtime_ns
+        if mtime != cache["mtime"]:
+            with open(GEMEINDEN_PATH, "r", encoding="utf-8") as f:
+                gdata = json.load(f)
+            # VGs after Gemeinden, and a Gemeinde wins if a name appears in both
+            abbr = dict(gdata["VGs"])
+            abbr.update(gdata["Gemeinden"])
+            cache["names"] = list(gdata["Gemeinden"].keys()) + list(gdata["VGs"].keys())
+            cache["abbr"] = abbr
+            cache["mtime"] = mtime
+        cache["checked_at"] = now
+    return cache
 
 
 def get_all_gemeinden():
-    data_path = Path("./data/gemeinden.json")
-    with open(data_path, "r", encoding="utf-8") as f:
-        gdata = json.load(f)
-    return list(gdata["Gemeinden"].keys()) + list(gdata["VGs"].keys())
+    return _gemeinden()["names"]
+
+
+def get_gemeinde_abbr(name):
+    """Abbreviation (e.g. SJU) of a Gemeinde or VG, or None if unknown."""
+    return _gemeinden()["abbr"].get(name)
@@ -0,0 +1,128 @@
+from . import database
+
+# Incoming rows are staged in a temp table so every check is one indexed join
+STAGE_TABLE = "dup_incoming"
+STAGE_COLUMNS = database.DUPLICATE_ID_COLUMNS + database.MATCH_KEY_COLUMNS
+
+FIELD_LABELS = {
+    "serialnummer": "Serialnummer",
+    "kv_id": "KV-ID",
+    "elo_nummer": "ELO-Nummer",
+    "match_key": "Produkt/Hersteller/Gemeinde/Bestelldatum",
+}
+
+
+def _clean(value):
+    """Blank values count as missing, like in the normalized key."""
+    if value is None:
+        return None
+    return str(value).strip() or None
+
+
+def _stage(conn, rows):
+    """Load the incoming rows into a fresh temp table; pos is the index in `rows`."""
+    cur = conn.cursor()
+    cur.execute(f"DROP TABLE IF EXISTS temp.{STAGE_TABLE};")
+    cur.execute(f"CREATE TEMP TABLE {STAGE_TABLE} (pos INTEGER PRIMARY KEY, {', '.join(STAGE_COLUMNS)});")
+    cur.executemany(
+        f"INSERT INTO {STAGE_TABLE} (pos, {', '.join(STAGE_COLUMNS)}) "
+        f"VALUES (?, {', '.join(['?'] * len(STAGE_COLUMNS))});",
+        (
+            (pos, *(_clean(row.get(col)) for col in STAGE_COLUMNS))
+            for pos, row in enumerate(rows)
+        ),
+    )
+    # indexes after the load: one sort per index is cheaper than updating them per row
+    for col in database.DUPLICATE_ID_COLUMNS:
+        cur.execute(f"CREATE INDEX temp.idx_{STAGE_TABLE}_{col} ON {STAGE_TABLE} ({col});")
+    cur.execute(f"CREATE INDEX temp.idx_{STAGE_TABLE}_match_key ON {STAGE_TABLE} ({database.match_key_sql()});")
+
+
+def find_duplicates(rows, conn=None):
+    """
+    Check incoming product rows (dicts) against the inventory and against each other.
+
+    Identifiers (serialnummer, kv_id, elo_nummer) must match exactly; rows without
+    them are compared by the normalized blocking key (database.match_key_sql).
+    Every check is an indexed lookup per incoming row, so the cost grows linearly
+    with the number of rows instead of comparing all pairs.
+
+    Returns {position in rows: [{"field": ..., "code": ...} or {"field": ..., "row": ...}]}
+    for rows with at least one match; "row" points at an earlier row of the same batch.
+    Use is_exact() to tell identifier matches from blocking-key suspicions.
+    """
+    if not rows:
+        return {}
+
+    conn = conn or database.get_connection()
+    # staging writes to the temp table open a transaction; only end the ones we started
+    own_transaction = not conn.in_transaction
+    _stage(conn, rows)
+    cur = conn.cursor()
+    matches = {}
+
+    # CROSS JOIN keeps the staged rows as the outer loop: the temp table has
+    # no statistics and the planner would otherwise scan the inventory instead
+
+    def collect(field, sql, key):
+        for pos, other in cur.execute(sql):
+            matches.setdefault(pos, []).append({"field": field, key: other})
+
+    for col in database.DUPLICATE_ID_COLUMNS:
+        collect(col, f"""
+            SELECT i.pos, inv.code FROM {STAGE_TABLE} i
+            CROSS JOIN inventory inv ON inv.{col} = i.{col}
+            WHERE i.{col} IS NOT NULL AND inv.{database.LIVE} ORDER BY i.pos, inv.code;
+        """, "code")
+        collect(col, f"""
+            SELECT b.pos, MIN(a.pos) FROM {STAGE_TABLE} b
+            JOIN {STAGE_TABLE} a ON a.{col} = b.{col} AND a.pos < b.pos
+            WHERE b.{col} IS NOT NULL GROUP BY b.pos;
+        """, "row")
+
+    # Blocking key: same normalized product/manufacturer/Gemeinde/order date and
+    # no identifier that tells the two apart (identical devices bought together
+    # usually differ in their serial numbers)
+    for left, right in (("inv", "i"), ("a", "b")):
+        key_match = f"{database.match_key_sql(left + '.')} = {database.match_key_sql(right + '.')}"
+        no_conflict = " AND ".join(
+            f"({left}.{col} IS NULL OR {left}.{col} = '' OR {right}.{col} IS NULL OR {left}.{col} = {right}.{col})"
+            for col in database.DUPLICATE_ID_COLUMNS
+        )
+        if left == "inv":
+            sql = f"""
+                SELECT i.pos, inv.code FROM {STAGE_TABLE} i
+                CROSS JOIN inventory inv ON {key_match} AND {no_conflict}
+                WHERE i.produkt IS NOT NULL AND inv.{database.LIVE} ORDER BY i.pos, inv.code;
+            """
+        else:
+            sql = f"""
+                SELECT b.pos, MIN(a.pos) FROM {STAGE_TABLE} b
+                JOIN {STAGE_TABLE} a ON {key_match} AND a.pos < b.pos AND {no_conflict}
+                WHERE b.produkt IS NOT NULL GROUP BY b.pos;
+            """
+        for pos, other in cur.execute(sql).fetchall():
+            found = matches.setdefault(pos, [])
+            # an identifier match already says more than the blocking key
+            if not any(m["field"] != "match_key" for m in found):
+                found.append({"field": "match_key", ("code" if left == "inv" else "row"): other})
+
+    cur.execute(f"DROP TABLE temp.{STAGE_TABLE};")
+    if own_transaction:
+        conn.commit()
+    return matches
+
+
+def is_exact(found):
+    """True if at least one match is on an identifier rather than the blocking key."""
+    return any(m["field"] != "match_key" for m in found)
+
+
+def describe(found):
+    """German one-line description of the matches of one row, e.g. for flash messages."""
+    parts = []
+    for m in found:
+        label = FIELD_LABELS.get(m["field"], m["field"])
+        target = m["code"] if "code" in m else f"Zeile {m['row']}"
+        parts.append(f"{target} ({label})")
+    return ", ".join(parts)
@@ -1,10 +1,35 @@
 import csv
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
 import pandas as pd
+import xlsxwriter
 from pathlib import Path
-from . import database
+from . import database, metrics
 
 EXPORT_PATH = Path("./data/inventory_export.xlsx")
 
+# Finished exports, reused while the inventory is unchanged (see "Export cache")
+EXPORT_CACHE_DIR = Path("./data/export_cache")
+EXPORT_CACHE_ENTRIES = int(os.environ.get("EXPORT_CACHE_ENTRIES", 8))
+# Half-written cache files older than this were left by a crashed process
+PART_MAX_AGE = 3600
+
+# Streamed to the client in pieces of this size
+STREAM_CHUNK_SIZE = 64 * 1024
+
+NUMERIC_COLS = {
+    "einzelpreis_netto",
+    "einzelpreis_brutto",
+    "mwst_satz",
+    "anzahl",
+    "anschaffungsjahr",
+}
+
 def export_to_excel():
     rows = database.get_all_products()
 
@@ -165,3 +190,169 @@ def export_to_csv():
 
     return EXPORT_PATH
 
+
+
+# -------------------- Streaming export --------------------
+
+def _clean_produktdetails(text):
+    """Same clean-up as export_to_csv: keep the text from breaking ;-separated CSV readers."""
+    return (
+        text.replace(',', '.').replace('"', '').replace('-', ' ').replace('(', ' ')
+        .replace(')', ' ').replace('\n', ' ').replace(';', '.')
+    )
+
+
+def iter_csv(rows):
+    """
+    Yield a ;-separated, UTF-8 (with BOM) CSV as encoded chunks.
+    `rows` is any iterable of PRODUCT_COLUMNS tuples, e.g. database.iter_products().
+    """
+    header = database.PRODUCT_COLUMNS
+    details_index = header.index("produktdetails")
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=";")
+    buffer.write("\ufeff")
+    writer.writerow(header)
+
+    # CSV is produced while it is sent, so this includes the time spent streaming
+    with metrics.timer("export_seconds", format="csv"):
+        for row in rows:
+            row = list(row)
+            if row[details_index]:
+                row[details_index] = _clean_produktdetails(row[details_index])
+            writer.writerow(row)
+
+            if buffer.tell() >= STREAM_CHUNK_SIZE:
+                yield buffer.getvalue().encode("utf-8")
+                buffer.seek(0)
+                buffer.truncate()
+
+        yield buffer.getvalue().encode("utf-8")
+
+
+def _excel_number(value):
+    """Numeric cell value, or None for empty/unparsable input (like pd.to_numeric(errors='coerce'))."""
+    if value is None or value == "":
+        return None
+    try:
+        number = float(str(value).replace(",", "."))
+    except ValueError:
+        return None
+    return int(number) if number.is_integer() else number
+
+
+@metrics.timed("export_seconds", format="xlsx")
+def write_xlsx(rows, fileobj):
+    """
+    Write rows to an .xlsx file object in xlsxwriter's constant_memory mode:
+    each row is flushed as it is written, so memory does not grow with the table.
+    """
+    header = database.PRODUCT_COLUMNS
+    numeric_index = {i for i, col in enumerate(header) if col in NUMERIC_COLS}
+
+    workbook = xlsxwriter.Workbook(fileobj, {"constant_memory": True})
+    sheet = workbook.add_worksheet("Sheet1")
+    bold = workbook.add_format({"bold": True})
+    sheet.write_row(0, 0, header, bold)
+
+    for r, row in enumerate(rows, start=1):
+        for c, value in enumerate(row):
+            if c in numeric_index:
+                value = _excel_number(value)
+            if value is None:
+                continue
+            sheet.write(r, c, value)
+
+    workbook.close()
+    return fileobj
+
+
+def iter_xlsx(rows):
+    """
+    Yield an .xlsx file as chunks. The zip container has to be finished before
+    it can be sent, so it is built in a private temporary file (deleted when
+    done) rather than a shared path under ./data.
+    """
+    with tempfile.TemporaryFile() as tmp:
+        write_xlsx(rows, tmp)
+        tmp.seek(0)
+        while True:
+            chunk = tmp.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+# -------------------- Export cache --------------------
+# Finished export files are kept under EXPORT_CACHE_DIR as
+# <change_seq>-<hash of format and selection>.<ext>. The same export asked
+# for again before the next inventory write is sent from the file; any
+# write moves database.current_change_seq() on, which retires all of them.
+
+def export_key(fmt, selection):
+    """
+    Cache key (and ETag) of an export: the current change counter plus a hash
+    of the format and `selection` (filters and sort, or codes). Read it
+    before reading the rows, so a file is never stored under a newer key than its data.
+    """
+    raw = json.dumps([fmt, selection], sort_keys=True, default=str, separators=(",", ":"))
+    return f"{database.current_change_seq()}-{hashlib.sha256(raw.encode('utf-8')).hexdigest()[:24]}"
+
+
+def _cache_path(key, fmt):
+    return EXPORT_CACHE_DIR / f"{key}.{'csv' if fmt == 'csv' else 'xlsx'}"
+
+
+def open_cached(key, fmt):
+    """The cached export as an open binary file, or None. Open handles survive eviction."""
+    path = _cache_path(key, fmt)
+    try:
+        fileobj = open(path, "rb")
+    except FileNotFoundError:
+        metrics.inc("export_cache_total", result="miss")
+        return None
+    metrics.inc("export_cache_total", result="hit")
+    os.utime(path)  # eviction keeps the most recently used
+    return fileobj
+
+
+def iter_cached(key, fmt, chunks):
+    """
+    Pass the export `chunks` through and store them under `key` once all were
+    produced. A download aborted halfway (the generator is closed) stores nothing.
+    """
+    EXPORT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    path = _cache_path(key, fmt)
+    # private name: two requests may build the same export at once
+    part = path.with_name(f"{path.name}.{os.getpid()}-{threading.get_ident()}.part")
+    try:
+        with open(part, "wb") as fileobj:
+            for chunk in chunks:
+                fileobj.write(chunk)
+                yield chunk
+        os.replace(part, path)
+    finally:
+        part.unlink(missing_ok=True)
+    _evict_cache()
+
+
+def _evict_cache():
+    """Drop exports of older change counters, then all but the EXPORT_CACHE_ENTRIES most recently used."""
+    current = database.current_change_seq()
+    kept = []
+    for path in EXPORT_CACHE_DIR.glob("*-*.*"):
+        try:
+            if path.suffix == ".part":
+                # still being written, unless its process died long ago
+                if path.stat().st_mtime < time.time() - PART_MAX_AGE:
+                    path.unlink(missing_ok=True)
+            elif int(path.name.split("-", 1)[0]) < current:
+                path.unlink(missing_ok=True)
+            else:
+                kept.append((path.stat().st_mtime, path))
+        except (ValueError, FileNotFoundError):
+            continue
+    kept.sort(reverse=True)
+    for _, path in kept[EXPORT_CACHE_ENTRIES:]:
+        path.unlink(missing_ok=True)
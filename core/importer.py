@@ -0,0 +1,339 @@
+import codecs
+import csv
+import datetime
+import uuid
+from pathlib import Path
+
+import pandas as pd
+from openpyxl import load_workbook
+
+from . import database, duplicates, utils
+
+IMPORT_DIR = Path("./data/imports")
+
+CHUNK_SIZE = 5000
+
+# Inventory columns a source column can be mapped to (code, erstellt_von and
+# geaendert_von are always set by the import itself)
+TARGET_COLUMNS = [
+    c for c in database.PRODUCT_COLUMNS if c not in ("code", "erstellt_von", "geaendert_von")
+]
+
+# Headers of the municipal tables we received so far (see database_harmonization.ipynb)
+DEFAULT_MAPPING = {
+    "Projekt": "projekt",
+    "Gemeinde": "gemeinde",
+    "Kategorie": "kategorie",
+    "Einsatzort": "einsatzort",
+    "Produkt": "produkt",
+    "Produktdetails": "produktdetails",
+    "KV-ID": "kv_id",
+    "Serialnr.": "serialnummer",
+    "Einzelpreis / netto": "einzelpreis_netto",
+    "Einzelpreis / brutto": "einzelpreis_brutto",
+    "preis_netto": "einzelpreis_netto",
+    "preis_brutto": "einzelpreis_brutto",
+    "Anzahl": "anzahl",
+    "ELO-Nummer": "elo_nummer",
+    "Geliefert am": "geliefert_am",
+    "Lieferumfang": "lieferumfang",
+    "Funktionsprüfung": "funktionspruefung",
+    "Notiz": "notiz",
+    "getestet am": "getestet_am",
+    "getestet von Kürzel": "getestet_von",
+    "übergeben": "uebergeben_am",
+    "Hersteller": "hersteller",
+    "Bestellt am": "bestellt_am",
+    "Bemerkungen": "bemerkungen",
+}
+
+DATE_COLUMNS = ["geliefert_am", "bestellt_am", "uebergeben_am", "getestet_am"]
+PRICE_COLUMNS = ["einzelpreis_netto", "einzelpreis_brutto"]
+
+
+# -------------------- Reading --------------------
+
+def _cp1252_fallback(error):
+    """Codec error handler: bytes that are not UTF-8 are read as Windows-1252 (one byte, one character)."""
+    return error.object[error.start:error.end].decode("cp1252"), error.end
+
+
+# Hand-edited exports are often UTF-8 with a few Windows-1252 characters typed
+# in later (or Windows-1252 throughout): every byte that is not valid UTF-8 is
+# read as Windows-1252, so neither kind of line is garbled
+codecs.register_error("cp1252_fallback", _cp1252_fallback)
+CSV_ENCODING = "utf-8-sig"
+CSV_ENCODING_ERRORS = "cp1252_fallback"
+
+
+def _detect_csv(path):
+    """
+    Check that the whole CSV file decodes (block by block, not loaded in full)
+    and guess its delimiter from the first line.
+    """
+    decoder = codecs.getincrementaldecoder(CSV_ENCODING)(CSV_ENCODING_ERRORS)
+    head = ""
+    try:
+        with open(path, "rb") as f:
+            while block := f.read(1024 * 1024):
+                text = decoder.decode(block)
+                head = head or text
+        decoder.decode(b"", final=True)
+    except UnicodeDecodeError:
+        raise ValueError("Die CSV-Datei ist weder UTF-8 noch Windows-1252 kodiert. Bitte als UTF-8 speichern.")
+
+    try:
+        sep = csv.Sniffer().sniff(head.splitlines()[0], delimiters=";,\t").delimiter
+    except (csv.Error, IndexError):
+        sep = ";"
+    return sep
+
+
+def read_chunks(path, chunksize=CHUNK_SIZE):
+    """
+    Yield the rows of a CSV or XLSX file as DataFrames of at most `chunksize` rows,
+    indexed by their line number in the file. Nothing is loaded in full.
+    """
+    path = Path(path)
+    if path.suffix.lower() in (".xlsx", ".xlsm"):
+        wb = load_workbook(path, read_only=True, data_only=True)
+        try:
+            rows = wb.active.iter_rows(values_only=True)
+            header = [str(h).strip() if h is not None else "" for h in next(rows, [])]
+            width = len(header)
+            batch, lines = [], []
+            for line, row in enumerate(rows, start=2):
+                if any(v not in (None, "") for v in row):
+                    row = tuple(row[:width])
+                    batch.append(row + (None,) * (width - len(row)))
+                    lines.append(line)
+                if len(batch) >= chunksize:
+                    yield pd.DataFrame(batch, columns=header, index=lines, dtype=object)
+                    batch, lines = [], []
+            if batch:
+                yield pd.DataFrame(batch, columns=header, index=lines, dtype=object)
+        finally:
+            wb.close()
+        return
+
+    sep = _detect_csv(path)
+    with open(path, encoding=CSV_ENCODING, errors=CSV_ENCODING_ERRORS, newline="") as f:
+        for chunk in pd.read_csv(f, sep=sep, dtype=str, chunksize=chunksize):
+            chunk.columns = [str(c).strip() for c in chunk.columns]
+            chunk.index = chunk.index + 2  # header is line 1
+            yield chunk.dropna(how="all")
+
+
+def read_header(path):
+    """Column names of an uploaded file (first chunk only)."""
+    for chunk in read_chunks(path, chunksize=1):
+        return list(chunk.columns)
+    return []
+
+
+def suggest_mapping(header, saved=None):
+    """Pre-fill the mapping form: saved mapping, then known headers, then exact column names."""
+    saved = saved or {}
+    mapping = {}
+    for col in header:
+        if col in saved:
+            mapping[col] = saved[col]
+        elif col in DEFAULT_MAPPING:
+            mapping[col] = DEFAULT_MAPPING[col]
+        elif col in TARGET_COLUMNS:
+            mapping[col] = col
+        else:
+            mapping[col] = ""
+    return mapping
+
+
+# -------------------- Normalization --------------------
+
+def _clean_prices(series):
+    """'1.234,56 €' / '12.5' / 12.5 -> float; a comma marks German notation."""
+    text = series.str.replace("€", "", regex=False).str.strip()
+    german = text.str.contains(",", regex=False, na=False)
+    text = text.mask(german, text.str.replace(".", "", regex=False).str.replace(",", ".", regex=False))
+    return pd.to_numeric(text, errors="coerce")
+
+
+def _clean_dates(series):
+    """Dates to yyyy-mm-dd; non-ISO dates are read day first (German tables). Unparsable text is kept."""
+    # ISO first: with dayfirst=True, "2025-01-05" would otherwise become the 1st of May
+    iso = pd.to_datetime(series.str[:10], format="%Y-%m-%d", errors="coerce")
+    other = pd.to_datetime(series.where(iso.isna()), dayfirst=True, errors="coerce", format="mixed")
+    parsed = iso.fillna(other)
+    return parsed.dt.strftime("%Y-%m-%d").fillna(series)
+
+
+def normalize_chunk(df, mapping, defaults):
+    """
+    Map a source chunk onto the inventory columns and clean it column-wise:
+    prices, VAT, category, dates, quantities and defaults.
+    Returns a DataFrame with exactly TARGET_COLUMNS (missing values as None).
+    """
+    rename = {src: dst for src, dst in mapping.items() if dst in TARGET_COLUMNS and src in df.columns}
+    out = df[list(rename)].rename(columns=rename)
+    # two source columns mapped to the same target: the first one is used
+    out = out.loc[:, ~out.columns.duplicated()]
+
+    # Everything as trimmed text first (XLSX cells arrive as numbers/datetimes, CSV as text)
+    out = out.astype("string").apply(lambda s: s.str.strip()).replace("", pd.NA)
+    for col in TARGET_COLUMNS:
+        if col not in out.columns:
+            out[col] = pd.Series(pd.NA, index=out.index, dtype="string")
+
+    for col in PRICE_COLUMNS:
+        out[col] = _clean_prices(out[col])
+    mwst = pd.to_numeric(out["mwst_satz"].str.replace(",", ".", regex=False), errors="coerce")
+    out["mwst_satz"] = mwst.fillna(float(defaults.get("mwst_satz") or 19))
+
+    out["einzelpreis_netto"], out["einzelpreis_brutto"] = utils.calculate_prices_series(
+        out["einzelpreis_netto"], out["einzelpreis_brutto"], out["mwst_satz"]
+    )
+
+    # Category 4 (Verbrauchsmaterial) is a manual decision and is kept; the rest follows the price
+    given = pd.to_numeric(out["kategorie"], errors="coerce")
+    out["kategorie"] = utils.assign_category_series(out["einzelpreis_netto"], given == 4)
+
+    for col in DATE_COLUMNS:
+        out[col] = _clean_dates(out[col])
+    out["bestellt_am"] = out["bestellt_am"].fillna(
+        defaults.get("bestellt_am") or datetime.date.today().isoformat()
+    )
+
+    # the order year only from dates _clean_dates could parse; kept unparsable text gives none
+    year = out["anschaffungsjahr"].str.extract(r"(\d{4})", expand=False)
+    ordered = pd.to_datetime(out["bestellt_am"], format="%Y-%m-%d", errors="coerce")
+    out["anschaffungsjahr"] = year.fillna(ordered.dt.strftime("%Y").astype("string"))
+
+    anzahl = pd.to_numeric(out["anzahl"], errors="coerce").fillna(1).astype(int)
+    out["anzahl"] = anzahl.where(anzahl > 0, 1)
+
+    if defaults.get("projekt"):
+        out["projekt"] = out["projekt"].fillna(defaults["projekt"])
+    if defaults.get("gemeinde"):
+        out["gemeinde"] = out["gemeinde"].fillna(defaults["gemeinde"])
+
+    out = out[TARGET_COLUMNS].astype(object)
+    return out.where(out.notna(), None)
+
+
+# -------------------- Import --------------------
+
+def save_upload(file_storage):
+    """Store an uploaded file under IMPORT_DIR with a random name; returns the token."""
+    suffix = Path(file_storage.filename or "").suffix.lower()
+    if suffix not in (".csv", ".txt", ".xlsx", ".xlsm"):
+        raise ValueError("Bitte eine CSV- oder Excel-Datei (.xlsx) hochladen.")
+    IMPORT_DIR.mkdir(parents=True, exist_ok=True)
+    token = f"{uuid.uuid4().hex}{suffix}"
+    file_storage.save(IMPORT_DIR / token)
+    return token
+
+
+def upload_path(token):
+    """Path of an uploaded file; rejects anything that is not a plain token."""
+    path = IMPORT_DIR / Path(token).name
+    if Path(token).name != token or not path.exists():
+        raise ValueError("Die hochgeladene Datei wurde nicht gefunden. Bitte erneut hochladen.")
+    return path
+
+
+def _assign_codes(df, conn):
+    """
+    Generate LL-ABR-YYMM-#### codes for a normalized chunk: one counter
+    reservation per (Gemeinde, month) group instead of one per row.
+    """
+    abbr = df["gemeinde"].map(database.get_gemeinde_abbr).str.upper()
+    parsed = pd.to_datetime(df["bestellt_am"], format="%Y-%m-%d", errors="coerce")
+    yymm = parsed.dt.strftime("%y%m").fillna(datetime.date.today().strftime("%y%m"))
+
+    position = df.groupby([abbr, yymm]).cumcount()
+    codes = pd.Series(index=df.index, dtype=object)
+    for (a, ym), idx in df.groupby([abbr, yymm]).groups.items():
+        last = database.reserve_sequence(a, ym, len(idx), conn)
+        first = last - len(idx) + 1
+        codes[idx] = [utils.format_code(a, ym, first + p) for p in position[idx]]
+    return codes
+
+
+def _check_duplicates(df, conn, policy):
+    """
+    Match a chunk against the inventory (earlier chunks are already inserted).
+    Returns (rows to drop, skipped entries, flagged entries).
+    """
+    found = duplicates.find_duplicates(df[duplicates.STAGE_COLUMNS].to_dict("records"), conn)
+    lines = list(df.index)
+    drop, skipped, flagged = [], [], []
+    for pos, matches in found.items():
+        # same-batch matches are reported by line number like the skipped rows
+        for m in matches:
+            if "row" in m:
+                m["row"] = int(lines[m["row"]])
+        entry = {"row": int(lines[pos]), "reason": f"Mögliches Duplikat von {duplicates.describe(matches)}"}
+        if policy == "skip_all" or (policy == "skip" and duplicates.is_exact(matches)):
+            drop.append(lines[pos])
+            skipped.append(entry)
+        else:
+            flagged.append(entry)
+    return drop, skipped, flagged
+
+
+def run_import(path, mapping, username, defaults=None, duplicate_policy="skip", chunksize=CHUNK_SIZE):
+    """
+    Import a CSV/XLSX file into the inventory in one transaction.
+    Rows without a known Gemeinde are skipped and reported. Duplicates (see
+    duplicates.find_duplicates) are handled by `duplicate_policy`:
+    "skip" drops identifier matches and only reports blocking-key suspicions,
+    "skip_all" drops both, "keep" imports everything and reports the matches.
+    Returns {"inserted": n, "skipped": [{"row": line, "reason": ...}],
+             "duplicates": [...reported, not skipped...],
+             "codes": [{"prefix", "first", "last", "count"}, ...]}.
+    "codes" has one entry per Gemeinde/month prefix (LL-ABR-YYMM); the import
+    holds the write lock throughout, so the codes of one prefix are consecutive.
+    """
+    defaults = defaults or {}
+    columns = ["code"] + TARGET_COLUMNS + ["erstellt_von", "geaendert_von"]
+    inserted = 0
+    skipped = []
+    flagged = []
+    code_ranges = {}
+
+    conn = database.get_connection()
+    with database.write_transaction(conn):
+        for chunk in read_chunks(path, chunksize):
+            df = normalize_chunk(chunk, mapping, defaults)
+
+            known = df["gemeinde"].map(database.get_gemeinde_abbr).notna()
+            for line in df.index[~known]:
+                skipped.append({"row": int(line), "reason": f"Unbekannte Gemeinde: {df.at[line, 'gemeinde']}"})
+            df = df[known]
+            if df.empty:
+                continue
+
+            drop, dup_skipped, dup_flagged = _check_duplicates(df, conn, duplicate_policy)
+            skipped += dup_skipped
+            flagged += dup_flagged
+            df = df.drop(index=drop)
+            if df.empty:
+                continue
+
+            df.insert(0, "code", _assign_codes(df, conn))
+            df["erstellt_von"] = username
+            df["geaendert_von"] = username
+
+            database.insert_products(df.itertuples(index=False, name=None), columns, conn, username)
+
+            inserted += len(df)
+            prefixes = df["code"].str.rsplit("-", n=1).str[0]
+            for prefix, codes in df["code"].groupby(prefixes, sort=False):
+                entry = code_ranges.setdefault(prefix, {"prefix": prefix, "first": codes.iloc[0], "count": 0})
+                entry["last"] = codes.iloc[-1]
+                entry["count"] += len(codes)
+
+    skipped.sort(key=lambda s: s["row"])
+    return {
+        "inserted": inserted, "skipped": skipped, "duplicates": flagged,
+        "codes": sorted(code_ranges.values(), key=lambda r: r["prefix"]),
+    }
@@ -0,0 +1,290 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from . import database, export_utils, label_printer, metrics
+
+# Finished artifacts, one file per job id
+JOB_DIR = Path("./data/jobs")
+
+# Pool size and how many jobs may be queued or running per process; overridable via init_app
+WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+MAX_PENDING = int(os.environ.get("JOB_MAX_PENDING", 10))
+
+# Finished jobs and their files are removed after this long
+RETENTION_SECONDS = int(os.environ.get("JOB_RETENTION_HOURS", 24)) * 3600
+# Each process touches heartbeat_at of its queued and running jobs this often;
+# a job without a heartbeat for STALE_SECONDS belonged to a process that died
+HEARTBEAT_SECONDS = int(os.environ.get("JOB_HEARTBEAT_SECONDS", 60))
+STALE_SECONDS = int(os.environ.get("JOB_STALE_MINUTES", 10)) * 60
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+log = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(MAX_PENDING)
+# Ids of this process's queued and running jobs, kept alive by _heartbeat()
+_live = set()
+_live_lock = threading.Lock()
+
+
+class QueueFull(RuntimeError):
+    """Raised by submit() when MAX_PENDING jobs are already queued or running."""
+
+
+# -------------------- Schema --------------------
+
+def create_table(conn):
+    """Create the jobs table. Does not commit."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            params TEXT NOT NULL,
+            created_by TEXT,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL,
+            heartbeat_at REAL,
+            filename TEXT,
+            mimetype TEXT,
+            artifact TEXT,
+            error TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created_at);")
+
+
+def add_heartbeat(conn):
+    """Add heartbeat_at to a jobs table created before it existed. Does not commit."""
+    if "heartbeat_at" not in database.table_columns(conn, "jobs"):
+        conn.execute("ALTER TABLE jobs ADD COLUMN heartbeat_at REAL;")
+
+
+# -------------------- Job kinds --------------------
+# Each kind writes its artifact to an open binary file and returns
+# (download filename, mimetype), or None when it produces no file.
+# Raising ValueError fails the job with that message.
+
+def _export(params, fileobj):
+    fmt = params.get("format")
+    # same selection as the direct download, so both share cached files
+    if params.get("codes") is not None:
+        selection = {"codes": params["codes"]}
+        rows = database.iter_products(codes=params["codes"])
+    else:
+        selection = {"filters": params.get("filters"), "sort": params.get("sort", "code"), "dir": params.get("dir", "asc")}
+        rows = database.iter_products(
+            filters=selection["filters"], sort=selection["sort"], direction=selection["dir"],
+        )
+    # before the rows are read (iter_products starts reading on first use)
+    key = export_utils.export_key(fmt, selection)
+    basename = params.get("basename", "Inventar")
+
+    cached = export_utils.open_cached(key, fmt)
+    if cached:
+        with cached:
+            shutil.copyfileobj(cached, fileobj)
+    else:
+        body = export_utils.iter_csv(rows) if fmt == "csv" else export_utils.iter_xlsx(rows)
+        for chunk in export_utils.iter_cached(key, fmt, body):
+            fileobj.write(chunk)
+
+    if fmt == "csv":
+        return f"{basename}.csv", "text/csv"
+    return f"{basename}.xlsx", XLSX_MIMETYPE
+
+
+def _labels(params, fileobj):
+    codes = database.existing_codes(params["ids"])
+    if not codes:
+        raise ValueError("Keine Produkte gefunden.")
+    pdf = label_printer.render_sheet(
+        ((code, code) for code in codes),
+        profile=params.get("profile", label_printer.DEFAULT_PROFILE),
+        start_offset=params.get("start_offset", 0),
+    )
+    fileobj.write(pdf.getbuffer())
+    return "Etiketten_Landlieben.pdf", "application/pdf"
+
+
+def _purge(params, fileobj):
+    database.purge_deleted(params.get("older_than_days"), archive=params.get("archive", True))
+    return None
+
+
+KINDS = {
+    "export": _export,
+    "labels": _labels,
+    "purge": _purge,
+}
+
+
+# -------------------- Queue --------------------
+
+def _pool():
+    # Created on first use, so each (forked) server process gets its own threads
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="job")
+            threading.Thread(target=_heartbeat, name="job-heartbeat", daemon=True).start()
+        return _executor
+
+
+def _heartbeat():
+    """Keep this process's pending jobs from being taken for orphans by cleanup()."""
+    conn = database.get_connection()
+    while True:
+        time.sleep(HEARTBEAT_SECONDS)
+        with _live_lock:
+            job_ids = list(_live)
+        if not job_ids:
+            continue
+        try:
+            with database.write_transaction(conn):
+                for chunk in database.chunked(job_ids):
+                    conn.execute(
+                        f"UPDATE jobs SET heartbeat_at=? WHERE id IN ({','.join(['?'] * len(chunk))});",
+                        [time.time(), *chunk],
+                    )
+        except Exception:
+            log.exception("Job heartbeat failed")
+
+
+def _update(conn, job_id, **fields):
+    with database.write_transaction(conn):
+        conn.execute(
+            f"UPDATE jobs SET {', '.join(f'{k}=?' for k in fields)} WHERE id=?;",
+            [*fields.values(), job_id],
+        )
+
+
+def _run(job_id, kind, params):
+    """Worker: produce the artifact and record the outcome. Runs outside any request."""
+    # pool threads have no app context, so this is the thread's own connection
+    conn = database.get_connection()
+    started = time.perf_counter()
+    part = JOB_DIR / f"{job_id}.part"
+    status = FAILED
+    try:
+        _update(conn, job_id, status=RUNNING, started_at=time.time())
+        with open(part, "wb") as fileobj:
+            produced = KINDS[kind](params, fileobj)
+        if produced is None:
+            part.unlink()
+            _update(conn, job_id, status=DONE, finished_at=time.time())
+        else:
+            artifact = JOB_DIR / job_id
+            os.replace(part, artifact)
+            filename, mimetype = produced
+            _update(conn, job_id, status=DONE, finished_at=time.time(),
+                    filename=filename, mimetype=mimetype, artifact=str(artifact))
+        status = DONE
+    except Exception as e:
+        if not isinstance(e, ValueError):
+            log.exception("Job %s (%s) failed", job_id, kind)
+        part.unlink(missing_ok=True)
+        if conn.in_transaction:
+            conn.rollback()
+        _update(conn, job_id, status=FAILED, finished_at=time.time(), error=str(e) or type(e).__name__)
+    finally:
+        with _live_lock:
+            _live.discard(job_id)
+        _slots.release()
+        metrics.observe("job_seconds", time.perf_counter() - started, kind=kind, status=status)
+
+
+def submit(kind, params, username=None):
+    """
+    Queue a job and return its id without waiting for it. Raises QueueFull
+    when MAX_PENDING jobs of this process are still queued or running, so a
+    burst of requests waits at the client instead of piling up here.
+    """
+    if kind not in KINDS:
+        raise ValueError(f"Unbekannte Auftragsart: {kind}")
+    if not _slots.acquire(blocking=False):
+        metrics.inc("jobs_rejected_total", kind=kind)
+        raise QueueFull("Zu viele laufende Aufträge, bitte später erneut versuchen.")
+
+    try:
+        JOB_DIR.mkdir(parents=True, exist_ok=True)
+        cleanup()
+        job_id = uuid.uuid4().hex
+        conn = database.get_connection()
+        now = time.time()
+        with database.write_transaction(conn):
+            conn.execute(
+                "INSERT INTO jobs (id, kind, status, params, created_by, created_at, heartbeat_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?);",
+                (job_id, kind, QUEUED, json.dumps(params), username, now, now),
+            )
+        with _live_lock:
+            _live.add(job_id)
+        _pool().submit(_run, job_id, kind, params)
+    except Exception:
+        with _live_lock:
+            _live.discard(job_id)
+        _slots.release()
+        raise
+    return job_id
+
+
+def get(job_id):
+    """The job as a dict (without params), or None."""
+    cur = database.get_connection().execute(
+        "SELECT id, kind, status, created_by, created_at, started_at, finished_at, "
+        "filename, mimetype, artifact, error FROM jobs WHERE id=?;",
+        (job_id,),
+    )
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return dict(zip([d[0] for d in cur.description], row))
+
+
+def cleanup(conn=None):
+    """
+    Fail jobs whose process is gone (no heartbeat for STALE_SECONDS; rows from
+    before the heartbeat fall back to created_at) and delete expired jobs with
+    their files.
+    """
+    conn = conn or database.get_connection()
+    now = time.time()
+    with database.write_transaction(conn):
+        conn.execute(
+            "UPDATE jobs SET status=?, finished_at=?, error=? "
+            "WHERE status IN (?, ?) AND coalesce(heartbeat_at, created_at) < ?;",
+            (FAILED, now, "Abgebrochen", QUEUED, RUNNING, now - STALE_SECONDS),
+        )
+        expired = conn.execute(
+            "SELECT id, artifact FROM jobs WHERE status IN (?, ?) AND finished_at < ?;",
+            (DONE, FAILED, now - RETENTION_SECONDS),
+        ).fetchall()
+        for chunk in database.chunked([job_id for job_id, _ in expired]):
+            conn.execute(f"DELETE FROM jobs WHERE id IN ({','.join(['?'] * len(chunk))});", chunk)
+    for _, artifact in expired:
+        if artifact:
+            Path(artifact).unlink(missing_ok=True)
+
+
+def init_app(app):
+    """Read the pool settings from app.config."""
+    global WORKERS, MAX_PENDING, JOB_DIR, HEARTBEAT_SECONDS, STALE_SECONDS, _slots
+    WORKERS = int(app.config.get("JOB_WORKERS", WORKERS))
+    MAX_PENDING = int(app.config.get("JOB_MAX_PENDING", MAX_PENDING))
+    JOB_DIR = Path(app.config.get("JOB_DIR", JOB_DIR))
+    HEARTBEAT_SECONDS = int(app.config.get("JOB_HEARTBEAT_SECONDS", HEARTBEAT_SECONDS))
+    STALE_SECONDS = int(app.config.get("JOB_STALE_MINUTES", STALE_SECONDS // 60)) * 60
+    _slots = threading.BoundedSemaphore(MAX_PENDING)
@@ -1,11 +1,241 @@
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
 from pathlib import Path
 from reportlab.pdfgen import canvas
+from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import mm
 from reportlab.graphics.barcode import code128
-from PyPDF2 import PdfMerger
+from . import database, metrics
 LABEL_DIR = Path("./data/labels")
 LABEL_DIR.mkdir(parents=True, exist_ok=True)
 
+# Label sheet layouts (all sizes in mm). A page of None means one label per
+# page with the page exactly the label size, i.e. a label printer roll.
+SHEET_PROFILES = {
+    "roll_22x6": dict(
+        title="Rolle 22 × 6 mm",
+        page=None, cols=1, rows=1,
+        label_w=22, label_h=6,
+        margin_x=0, margin_y=0, gap_x=0, gap_y=0,
+    ),
+    "a4_3x8": dict(
+        title="A4 3 × 8 (63 × 33 mm)",
+        page=A4, cols=3, rows=8,
+        label_w=63, label_h=33,
+        margin_x=10, margin_y=10, gap_x=2, gap_y=2,
+    ),
+    "a4_4x10": dict(
+        title="A4 4 × 10 (48,5 × 25,4 mm)",
+        page=A4, cols=4, rows=10,
+        label_w=48.5, label_h=25.4,
+        margin_x=8, margin_y=21.5, gap_x=0, gap_y=0,
+    ),
+}
+DEFAULT_PROFILE = "roll_22x6"
+
+# Rendered barcodes are cached in memory (LRU) and on disk, both bounded in bytes
+FRAGMENT_DB = LABEL_DIR / "fragments.db"
+FRAGMENT_MEMORY_BYTES = int(os.environ.get("LABEL_CACHE_MEMORY_MB", 16)) * 1024 * 1024
+FRAGMENT_DISK_BYTES = int(os.environ.get("LABEL_CACHE_DISK_MB", 256)) * 1024 * 1024
+# Part of every cache key; bump when the barcode drawing changes
+FRAGMENT_VERSION = 1
+
+def barcode_bars(code_text, bar_width, bar_height):
+    """
+    Geometry of a Code128 symbol: (width, height, [(x, bar_width), ...]).
+    Computed once per label; Code128.width/.height would re-encode on every access.
+    """
+    bc = code128.Code128(code_text, barWidth=bar_width, barHeight=bar_height)
+    bc.validate()
+    bc.encode()
+    bc.decompose()
+
+    bars = []
+    left = bc.lquiet if bc.quiet else 0
+    for ch in bc.decomposed:
+        if "a" <= ch <= "z":      # space, width in modules
+            left += (ord(ch) - 96) * bar_width
+        elif "A" <= ch <= "Z":    # bar, width in modules
+            w = (ord(ch) - 64) * bar_width
+            bars.append((left, w))
+            left += w
+
+    width = left + (bc.rquiet if bc.quiet else 0)
+    return width, bar_height, bars
+
+
+# -------------------- Barcode fragments --------------------
+# A fragment is the PDF drawing operators of one barcode, relative to the
+# lower-left corner of its label. Fragments are kept in an in-process LRU and
+# in data/labels/fragments.db under the hash of everything that shapes the
+# drawing, so reprints skip the Code128 encoding. The cache file can be
+# deleted at any time.
+
+_fragment_lock = threading.Lock()
+_fragments = OrderedDict()      # key -> operators, least recently used first
+_fragment_memory = {"bytes": 0}
+_fragment_local = threading.local()
+
+# A disk hit refreshes its last use at most this often (saves a write per reprint)
+FRAGMENT_TOUCH_INTERVAL = 3600
+
+
+def _fragment_key(code_text, width_mm, height_mm):
+    raw = f"{FRAGMENT_VERSION}\0{code_text}\0{width_mm}\0{height_mm}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _fragment_db():
+    """This thread's connection to the fragment cache file.
+
+    A plain sqlite3 connection: cache lookups are not inventory queries and
+    must not show up in the per-request SQL counters.
+    """
+    conn = getattr(_fragment_local, "conn", None)
+    if conn is None:
+        FRAGMENT_DB.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(FRAGMENT_DB, timeout=database.BUSY_TIMEOUT_MS / 1000)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS fragments (
+                key TEXT PRIMARY KEY,
+                ops TEXT NOT NULL,
+                used_at REAL NOT NULL
+            ) WITHOUT ROWID
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_fragments_used_at ON fragments(used_at);")
+        conn.commit()
+        _fragment_local.conn = conn
+    return conn
+
+
+def _build_fragment(code_text, width_mm, height_mm):
+    """Barcode operators centred in a width_mm x height_mm box at the origin."""
+    scale = min(width_mm / 22, height_mm / 6)
+    bc_width, bc_height, bars = barcode_bars(code_text, 0.1 * mm * scale, height_mm * 0.4 * mm)
+
+    x = (width_mm * mm - bc_width) / 2
+    y = (height_mm * mm - bc_height) / 2
+
+    # All bars as one filled path, written as raw operators: far cheaper than a canvas.rect() per bar
+    ops = " ".join(f"{x + bx:.3f} {y:.3f} {bw:.3f} {bc_height:.3f} re" for bx, bw in bars)
+    return f"0 g {ops} f"
+
+
+def _remember(found):
+    """Put {key: ops} into the memory LRU, evicting the least recently used beyond its size."""
+    with _fragment_lock:
+        for key, ops in found.items():
+            if key in _fragments:
+                _fragments.move_to_end(key)
+                continue
+            _fragments[key] = ops
+            _fragment_memory["bytes"] += len(ops)
+        while _fragment_memory["bytes"] > FRAGMENT_MEMORY_BYTES and len(_fragments) > 1:
+            _, evicted = _fragments.popitem(last=False)
+            _fragment_memory["bytes"] -= len(evicted)
+
+
+def _evict_disk(conn):
+    """Drop the least recently used fragments once the cache file holds more than FRAGMENT_DISK_BYTES."""
+    page_size = conn.execute("PRAGMA page_size;").fetchone()[0]
+    pages = conn.execute("PRAGMA page_count;").fetchone()[0] - conn.execute("PRAGMA freelist_count;").fetchone()[0]
+    used = pages * page_size
+    if used <= FRAGMENT_DISK_BYTES:
+        return
+    # free pages are reused by later inserts, so the file stops growing
+    rows = conn.execute("SELECT COUNT(*) FROM fragments;").fetchone()[0]
+    drop = max(1, int(rows * (1 - FRAGMENT_DISK_BYTES * 0.8 / used)))
+    conn.execute(
+        "DELETE FROM fragments WHERE key IN (SELECT key FROM fragments ORDER BY used_at LIMIT ?);",
+        (drop,),
+    )
+
+
+def barcode_fragments(codes, width_mm=22, height_mm=6):
+    """
+    {code: operators} for all `codes` on labels of the given size: from
+    memory, else from the cache file, else rendered and stored in both.
+    Looks up and stores the whole batch at once.
+    """
+    keys = {code: _fragment_key(code, width_mm, height_mm) for code in codes}
+    found = {}
+    with _fragment_lock:
+        for key in keys.values():
+            ops = _fragments.get(key)
+            if ops is not None:
+                _fragments.move_to_end(key)
+                found[key] = ops
+
+    missing = [key for key in keys.values() if key not in found]
+    if missing:
+        conn = _fragment_db()
+        now = time.time()
+        for chunk in database.chunked(missing):
+            marks = ",".join("?" * len(chunk))
+            found.update(conn.execute(f"SELECT key, ops FROM fragments WHERE key IN ({marks});", chunk))
+            conn.execute(
+                f"UPDATE fragments SET used_at=? WHERE key IN ({marks}) AND used_at < ?;",
+                [now, *chunk, now - FRAGMENT_TOUCH_INTERVAL],
+            )
+
+        built = {key: _build_fragment(code, width_mm, height_mm)
+                 for code, key in keys.items() if key not in found}
+        conn.executemany(
+            "INSERT OR REPLACE INTO fragments (key, ops, used_at) VALUES (?, ?, ?);",
+            [(key, ops, now) for key, ops in built.items()],
+        )
+        if built:
+            _evict_disk(conn)
+        conn.commit()
+
+        metrics.inc("label_fragments_total", len(missing) - len(built), source="disk")
+        metrics.inc("label_fragments_total", len(built), source="rendered")
+        found.update(built)
+        _remember(found)
+
+    metrics.inc("label_fragments_total", len(keys) - len(missing), source="memory")
+    return {code: found[key] for code, key in keys.items()}
+
+
+def clear_fragment_cache(disk=False):
+    """Forget cached barcodes (and empty the cache file with disk=True)."""
+    with _fragment_lock:
+        _fragments.clear()
+        _fragment_memory["bytes"] = 0
+    if disk:
+        conn = _fragment_db()
+        conn.execute("DELETE FROM fragments;")
+        conn.commit()
+
+
+def draw_label(c, code_text, label_text, width_mm=22, height_mm=6, x0=0, y0=0, fragment=None):
+    """
+    Draw one Code128 label with its caption onto canvas `c`, lower-left corner at (x0, y0).
+    Bar width, font and spacing are designed for 22 x 6 mm and scale with larger labels.
+    `fragment` is the barcode from barcode_fragments(); looked up when not given.
+    """
+    if fragment is None:
+        fragment = barcode_fragments([code_text], width_mm, height_mm)[code_text]
+    scale = min(width_mm / 22, height_mm / 6)
+    c.addLiteral(f"q 1 0 0 1 {x0:.3f} {y0:.3f} cm {fragment} Q")
+
+    # the caption sits just below the barcode, which is centred vertically
+    bc_height = height_mm * 0.4 * mm
+    y = y0 + (height_mm * mm - bc_height) / 2
+
+    text_to_show = label_text or code_text
+    font_size = 3 * scale
+    c.setFont("Helvetica", font_size)
+    text_width = c.stringWidth(text_to_show, "Helvetica", font_size)
+    c.drawString(x0 + (width_mm * mm - text_width) / 2, y - 1 * mm * scale, text_to_show)
+
+
 def make_pdf_label(
     code_text,
     output_dir,
@@ -19,20 +249,7 @@ def make_pdf_label(
     file_path = output_dir / f"{code_text}.pdf"
     c = canvas.Canvas(str(file_path), pagesize=(width_mm * mm, height_mm * mm))
 
-    bc = code128.Code128(
-        code_text,
-        barWidth=0.1 * mm,
-        barHeight=height_mm * 0.4 * mm,
-    )
-
-    x = (width_mm * mm - bc.width) / 2
-    y = (height_mm * mm - bc.height) / 2
-    bc.drawOn(c, x, y)
-
-    text_to_show = label_text or code_text
-    c.setFont("Helvetica", 3)
-    text_width = c.stringWidth(text_to_show, "Helvetica", 3)
-    c.drawString((width_mm * mm - text_width) / 2, y - 1 * mm, text_to_show)
+    draw_label(c, code_text, label_text, width_mm, height_mm)
 
     c.showPage()
     c.save()
@@ -40,17 +257,55 @@ def make_pdf_label(
     return file_path
 
 
-def merge_pdfs(pdf_paths, output_file):
-    merger = PdfMerger()
+def sheet_profile(name):
+    """The layout of a named profile (see SHEET_PROFILES); ValueError for anything else."""
+    if not isinstance(name, str) or name not in SHEET_PROFILES:
+        raise ValueError(f"Unbekanntes Etikettenformat: {name}")
+    return SHEET_PROFILES[name]
 
-    for pdf in pdf_paths:
-        merger.append(str(pdf))
 
-    output_file = Path(output_file)
-    output_file.parent.mkdir(parents=True, exist_ok=True)
+@metrics.timed("pdf_render_seconds")
+def render_sheet(labels, profile=DEFAULT_PROFILE, start_offset=0):
+    """
+    Lay labels ((code_text, label_text) pairs) out on sheets of the given
+    profile (a name in SHEET_PROFILES) and return the PDF as a BytesIO
+    positioned at the start; nothing is written to disk. Pages are added as needed.
+    `start_offset` skips that many positions on the first sheet, for sheets
+    that are already partly used.
+    """
+    profile = sheet_profile(profile)
 
-    merger.write(str(output_file))
-    merger.close()
+    label_w, label_h = profile["label_w"], profile["label_h"]
+    page = profile["page"] or (label_w * mm, label_h * mm)
+    per_page = profile["cols"] * profile["rows"]
+    page_h = page[1]
 
-    return output_file
+    labels = list(labels)
+    fragments = barcode_fragments({code for code, _ in labels}, label_w, label_h)
 
+    buffer = io.BytesIO()
+    # Label pages are small; compressing each one costs more time than it saves bytes
+    c = canvas.Canvas(buffer, pagesize=page, pageCompression=0)
+
+    slot = max(0, int(start_offset or 0)) % per_page
+    drawn = False
+    for code_text, label_text in labels:
+        if slot == per_page:
+            c.showPage()
+            slot = 0
+
+        col = slot % profile["cols"]
+        row = slot // profile["cols"]
+        x = (profile["margin_x"] + col * (label_w + profile["gap_x"])) * mm
+        # rows are counted from the top of the sheet
+        y = page_h - (profile["margin_y"] + row * (label_h + profile["gap_y"]) + label_h) * mm
+
+        draw_label(c, code_text, label_text, label_w, label_h, x, y, fragments[code_text])
+        drawn = True
+        slot += 1
+
+    if drawn:
+        c.showPage()
+    c.save()
+    buffer.seek(0)
+    return buffer
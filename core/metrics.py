@@ -0,0 +1,223 @@
+import functools
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, has_request_context, request
+
+# Requests slower than this are logged (milliseconds, 0 = off)
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", 0))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 1000)
+
+# name -> (type, help, buckets)
+METRICS = {
+    "http_request_duration_seconds": (
+        "histogram", "Time until the response object was returned, per endpoint.", LATENCY_BUCKETS),
+    "http_request_sql_queries": (
+        "histogram", "SQL statements executed per request.", COUNT_BUCKETS),
+    "http_request_sql_seconds": (
+        "histogram", "Time spent in SQL statements per request.", LATENCY_BUCKETS),
+    "http_slow_requests_total": (
+        "counter", "Requests slower than SLOW_REQUEST_MS.", None),
+    "sql_queries_total": (
+        "counter", "SQL statements executed, including work outside requests.", None),
+    "sql_seconds_total": (
+        "counter", "Time spent in SQL statements.", None),
+    "pdf_render_seconds": (
+        "histogram", "Time to render a label PDF.", LATENCY_BUCKETS),
+    "label_fragments_total": (
+        "counter", "Barcodes drawn on labels, by where they came from (memory, disk, rendered).", None),
+    "export_seconds": (
+        "histogram", "Time to produce an export, per format (CSV: until fully streamed).", LATENCY_BUCKETS),
+    "export_cache_total": (
+        "counter", "Export downloads by whether the cached file could be sent (hit, miss).", None),
+    "http_response_bytes_total": (
+        "counter", "Bodies of compressed responses before (encoding=identity) and after compression.", None),
+    "scanned_codes_total": (
+        "counter", "Codes resolved by the batch scan API, by outcome (found, deleted, unknown).", None),
+    "job_seconds": (
+        "histogram", "Run time of background jobs, per kind and outcome.", LATENCY_BUCKETS),
+    "jobs_rejected_total": (
+        "counter", "Jobs refused because the queue was full.", None),
+}
+
+_lock = threading.Lock()
+# name -> {label tuple: [bucket counts..., sum, count]} for histograms, {label tuple: value} for counters
+_series = {name: {} for name in METRICS}
+
+
+# -------------------- Recording --------------------
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def observe(name, value, **labels):
+    """Add one observation to a histogram."""
+    buckets = METRICS[name][2]
+    key = _labels(labels)
+    with _lock:
+        series = _series[name].get(key)
+        if series is None:
+            series = _series[name][key] = [0] * (len(buckets) + 2)
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+
+def inc(name, value=1, **labels):
+    """Increase a counter."""
+    key = _labels(labels)
+    with _lock:
+        _series[name][key] = _series[name].get(key, 0) + value
+
+
+@contextmanager
+def timer(name, **labels):
+    """Observe the duration of a block in the histogram `name`."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+def timed(name, **labels):
+    """Decorator form of timer()."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# -------------------- SQL --------------------
+
+def _record_query(started):
+    elapsed = time.perf_counter() - started
+    inc("sql_queries_total")
+    inc("sql_seconds_total", elapsed)
+    if has_request_context() and "metrics_started" in g:
+        g.sql_queries += 1
+        g.sql_seconds += elapsed
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that counts its statements and the time spent executing them."""
+
+    def execute(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().execute(*args, **kwargs)
+        finally:
+            _record_query(started)
+
+    def executemany(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().executemany(*args, **kwargs)
+        finally:
+            _record_query(started)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """
+    Connection factory for database.connect(). The shortcut methods
+    (conn.execute, ...) go through cursor(), so every statement is counted.
+    Rows fetched later are not part of the measured time.
+    """
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args, **kwargs):
+        return self.cursor().execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        return self.cursor().executemany(*args, **kwargs)
+
+
+# -------------------- Requests --------------------
+
+def _before_request():
+    g.metrics_started = time.perf_counter()
+    g.sql_queries = 0
+    g.sql_seconds = 0.0
+
+
+def _after_request(response):
+    started = g.pop("metrics_started", None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    # the rule's endpoint keeps the label set small (unknown URLs share one label)
+    endpoint = request.endpoint or "unmatched"
+
+    observe("http_request_duration_seconds", elapsed,
+            endpoint=endpoint, method=request.method, status=str(response.status_code))
+    observe("http_request_sql_queries", g.sql_queries, endpoint=endpoint)
+    observe("http_request_sql_seconds", g.sql_seconds, endpoint=endpoint)
+
+    if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+        inc("http_slow_requests_total", endpoint=endpoint)
+        current_app.logger.warning(
+            "Slow request %s %s -> %s: %.0f ms, %d SQL statements, %.0f ms SQL",
+            request.method, request.full_path.rstrip("?"), response.status_code,
+            elapsed * 1000, g.sql_queries, g.sql_seconds * 1000,
+        )
+    return response
+
+
+def init_app(app):
+    """Time every request of `app`."""
+    global SLOW_REQUEST_MS
+    SLOW_REQUEST_MS = float(app.config.get("SLOW_REQUEST_MS", SLOW_REQUEST_MS))
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+
+
+# -------------------- Exposition --------------------
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    with _lock:
+        snapshot = {name: {k: list(v) if isinstance(v, list) else v for k, v in s.items()}
+                    for name, s in _series.items()}
+
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in sorted(snapshot[name].items()):
+            if kind == "counter":
+                lines.append(f"{name}{_format_labels(labels)} {_number(value)}")
+                continue
+            for bound, count in zip(buckets, value):
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {value[-1]}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_number(value[-2])}")
+            lines.append(f"{name}_count{_format_labels(labels)} {value[-1]}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,234 @@
+import time
+
+from . import database, jobs, reports
+
+# Column names of earlier databases (see database_harmonization.ipynb)
+LEGACY_RENAMES = {
+    "produkttyp": "produkt",
+    "inventarnummer": "kv_id",
+    "preis_netto": "einzelpreis_netto",
+    "preis_brutto": "einzelpreis_brutto",
+}
+
+# Values for NULLs in columns that are NOT NULL in the current layout
+NOT_NULL_FALLBACKS = {"gemeinde": "''", "version": "0"}
+
+# Rows copied per INSERT ... SELECT when a table is rebuilt
+REBUILD_BATCH_SIZE = 5000
+
+
+# -------------------- Helpers --------------------
+
+def current_version(conn):
+    return conn.execute("PRAGMA user_version;").fetchone()[0]
+
+
+def _table_exists(conn, name):
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?;", (name,)).fetchone()
+    return row is not None
+
+
+def _declared_types(conn, table):
+    """{column: declared type} of a table, types upper-cased."""
+    return {row[1]: (row[2] or "").upper() for row in conn.execute(f"PRAGMA table_info({table});")}
+
+
+def _addable(decl):
+    """ALTER TABLE ADD COLUMN cannot add UNIQUE columns or NOT NULL ones without a default."""
+    decl = decl.upper()
+    return "UNIQUE" not in decl and ("NOT NULL" not in decl or "DEFAULT" in decl)
+
+
+def rebuild_inventory(conn, source):
+    """
+    Copy `source` into a fresh table with the current inventory layout and
+    swap it in. Legacy column names are mapped (LEGACY_RENAMES); columns the
+    current layout does not know are kept at the end of the table.
+    Rows are copied in rowid batches, rowids are preserved. Must run inside
+    a transaction: a failure leaves the old table untouched.
+    """
+    target = {col: decl for col, decl in database.INVENTORY_SCHEMA}
+    source_cols = list(_declared_types(conn, source))
+
+    # Same-named columns win over renamed legacy ones
+    mapping = {col: col for col in source_cols if col in target}
+    for col in source_cols:
+        renamed = LEGACY_RENAMES.get(col)
+        if renamed in target and renamed not in mapping.values():
+            mapping[col] = renamed
+    extras = [col for col in source_cols if col not in mapping]
+    mapping.update({col: col for col in extras})
+
+    def select_expr(src, dst):
+        # NOT NULL columns may hold NULLs in tables built by hand
+        if dst in NOT_NULL_FALLBACKS:
+            return f"COALESCE({src}, {NOT_NULL_FALLBACKS[dst]})"
+        return src
+
+    conn.execute("DROP TABLE IF EXISTS inventory_rebuild;")
+    database.create_inventory_table(conn, "inventory_rebuild", extras)
+
+    dst_cols = ", ".join(["rowid"] + list(mapping.values()))
+    src_exprs = ", ".join(["rowid"] + [select_expr(src, dst) for src, dst in mapping.items()])
+    low, high = conn.execute(f"SELECT MIN(rowid), MAX(rowid) FROM {source};").fetchone()
+    copied = 0
+    if low is not None:
+        for start in range(low, high + 1, REBUILD_BATCH_SIZE):
+            cur = conn.execute(
+                f"INSERT INTO inventory_rebuild ({dst_cols}) "
+                f"SELECT {src_exprs} FROM {source} WHERE rowid >= ? AND rowid < ?;",
+                (start, start + REBUILD_BATCH_SIZE),
+            )
+            copied += cur.rowcount
+
+    had_search_index = _table_exists(conn, "inventory_fts")
+    had_summary = _table_exists(conn, reports.SUMMARY_TABLE)
+    conn.execute(f"DROP TABLE {source};")
+    conn.execute("ALTER TABLE inventory_rebuild RENAME TO inventory;")
+
+    # Indexes and triggers went with the old table; derived data is recomputed
+    database.create_indexes(conn)
+    database.create_duplicate_indexes(conn)
+    if had_search_index:
+        database.create_search_index(conn)
+        database.rebuild_search_index(conn)
+    if had_summary:
+        reports.create_summary(conn)
+        reports.rebuild_summary(conn)
+
+    print(f"Rebuilt inventory from '{source}': {copied} rows, {len(extras)} extra column(s) kept.")
+    return copied
+
+
+# -------------------- Steps --------------------
+# Every step must be safe on a database that already has its changes:
+# databases created before the runner existed start at user_version 0.
+# Steps call the live create_* helpers, which expect the current inventory
+# layout (partial indexes and triggers on deleted_at, change_seq, ...). A
+# step that builds on inventory columns therefore runs _inventory_layout()
+# first: on a database from an older version it adds the columns later
+# steps introduced (instant ALTER TABLE ADD COLUMN), otherwise it does nothing.
+
+def _base_tables(conn):
+    database.create_users_table(conn)
+    database.create_options_table(conn)
+    database.create_code_sequences(conn)
+    database.create_import_mappings(conn)
+
+
+def _inventory_layout(conn):
+    """Bring the products table to INVENTORY_SCHEMA, rebuilding it only when needed."""
+    if not _table_exists(conn, "inventory"):
+        # The first version of the app called the table 'products'
+        if _table_exists(conn, "products"):
+            rebuild_inventory(conn, "products")
+        else:
+            database.create_inventory_table(conn)
+        return
+
+    existing = _declared_types(conn, "inventory")
+    missing = [(col, decl) for col, decl in database.INVENTORY_SCHEMA if col not in existing]
+    retyped = [
+        col for col, decl in database.INVENTORY_SCHEMA
+        if col in existing and existing[col] != decl.split()[0]
+    ]
+    legacy = [col for col in existing if col in LEGACY_RENAMES]
+
+    if retyped or legacy or not all(_addable(decl) for _, decl in missing):
+        rebuild_inventory(conn, "inventory")
+        return
+    # Only new columns: ALTER TABLE is instant, no copy needed
+    for col, decl in missing:
+        conn.execute(f"ALTER TABLE inventory ADD COLUMN {col} {decl};")
+
+
+def _inventory_indexes(conn):
+    _inventory_layout(conn)
+    database.create_indexes(conn)
+    database.create_duplicate_indexes(conn)
+
+
+def _search_index(conn):
+    _inventory_layout(conn)
+    database.create_search_index(conn)
+
+
+def _report_totals(conn):
+    _inventory_layout(conn)
+    reports.create_summary(conn)
+    reports.rebuild_summary(conn)
+
+
+def _jobs(conn):
+    jobs.create_table(conn)
+
+
+def _soft_delete(conn):
+    # adds deleted_at/deleted_by and the archive; the sort indexes become
+    # partial and the report triggers are redefined, so tombstones drop out
+    _inventory_layout(conn)
+    for col in database.SORTABLE_COLUMNS:
+        conn.execute(f"DROP INDEX IF EXISTS idx_inventory_{col};")
+    database.create_indexes(conn)
+    database.create_archive_table(conn)
+    reports.create_summary(conn, replace_triggers=True)
+    reports.rebuild_summary(conn)
+
+
+def _audit_log(conn):
+    database.create_audit_table(conn)
+
+
+def _change_counter(conn):
+    # change_seq starts at 0 everywhere, which is the counter's start value too
+    _inventory_layout(conn)
+    database.create_indexes(conn)
+    database.create_sync_state(conn)
+
+
+def _report_totals_live_only(conn):
+    # tombstones no longer write zero rows; the rebuild drops the ones left behind
+    reports.create_summary(conn, replace_triggers=True)
+    reports.rebuild_summary(conn)
+
+
+def _job_heartbeat(conn):
+    jobs.add_heartbeat(conn)
+
+
+# (user_version, description, step) — append only, never renumber
+MIGRATIONS = [
+    (1, "base tables", _base_tables),
+    (2, "inventory layout", _inventory_layout),
+    (3, "inventory indexes", _inventory_indexes),
+    (4, "full-text search index", _search_index),
+    (5, "report totals", _report_totals),
+    (6, "background jobs", _jobs),
+    (7, "soft delete", _soft_delete),
+    (8, "change history", _audit_log),
+    (9, "change counter", _change_counter),
+    (10, "report totals without deleted keys", _report_totals_live_only),
+    (11, "job heartbeat", _job_heartbeat),
+]
+
+
+# -------------------- Runner --------------------
+
+def migrate(conn):
+    """
+    Apply all pending steps in order. Each step runs in its own write
+    transaction together with its PRAGMA user_version bump, so an interrupted
+    upgrade resumes at the step that failed. Returns the resulting version.
+    """
+    for number, description, step in MIGRATIONS:
+        if number <= current_version(conn):
+            continue
+        started = time.perf_counter()
+        with database.write_transaction(conn):
+            # another process may have applied it while we waited for the lock
+            if number <= current_version(conn):
+                continue
+            step(conn)
+            conn.execute(f"PRAGMA user_version = {number};")
+        print(f"Migration {number} ({description}) applied in {time.perf_counter() - started:.2f}s")
+    return current_version(conn)
@@ -0,0 +1,179 @@
+from . import database
+
+# Report dimensions: inventory column -> heading on /berichte
+DIMENSIONS = {
+    "gemeinde": "Gemeinde",
+    "projekt": "Projekt",
+    "kategorie": "Kategorie",
+    "anschaffungsjahr": "Anschaffungsjahr",
+    "hersteller": "Hersteller",
+}
+
+# Everything in one row, used for the overall totals
+TOTAL = "gesamt"
+
+CATEGORY_LABELS = {
+    "1": "1 – über 1000 €",
+    "2": "2 – 50 bis 1000 €",
+    "3": "3 – unter 50 €",
+    "4": "4 – Verbrauchsmaterial",
+}
+
+# Columns whose changes move a row between or within the totals
+TRACKED_COLUMNS = list(DIMENSIONS) + [
+    "anzahl", "einzelpreis_netto", "einzelpreis_brutto", "geliefert_am", "uebergeben_am", "deleted_at",
+]
+
+SUMMARY_TRIGGERS = ["report_totals_ai", "report_totals_ad", "report_totals_au"]
+
+SUMMARY_TABLE = "report_totals"
+SUMMARY_COLUMNS = ["positions", "stueck", "netto_cent", "brutto_cent", "geliefert", "uebergeben"]
+
+
+# -------------------- Summary table --------------------
+# Totals per (dimension, key) are kept up to date by triggers on inventory:
+# a row adds its contribution on insert, removes it on delete and does both
+# on an update of a tracked column. Money is summed in integer cents so the
+# running totals never drift. Deleted rows (tombstones) contribute nothing
+# and write nothing: a zero upsert would bring back a key whose last live
+# row was just deleted.
+
+def _contribution(row):
+    """SQL values of one live inventory row (`new` or `old`) in SUMMARY_COLUMNS order."""
+    qty = f"COALESCE({row}.anzahl, 1)"
+    return [
+        "1",
+        qty,
+        f"CAST(ROUND(COALESCE({row}.einzelpreis_netto, 0) * 100) AS INTEGER) * {qty}",
+        f"CAST(ROUND(COALESCE({row}.einzelpreis_brutto, 0) * 100) AS INTEGER) * {qty}",
+        f"CASE WHEN COALESCE({row}.geliefert_am, '') != '' THEN {qty} ELSE 0 END",
+        f"CASE WHEN COALESCE({row}.uebergeben_am, '') != '' THEN {qty} ELSE 0 END",
+    ]
+
+
+def _key(dimension, row):
+    if dimension == TOTAL:
+        return "''"
+    return f"COALESCE(CAST({row}.{dimension} AS TEXT), '')"
+
+
+def _apply_sql(row, sign):
+    """Upserts adding (sign '+') or removing (sign '-') a row's contribution in every dimension."""
+    values = _contribution(row)
+    if sign == "-":
+        values = [f"-({v})" for v in values]
+    updates = ", ".join(f"{c} = {c} + excluded.{c}" for c in SUMMARY_COLUMNS)
+    statements = [
+        f"INSERT INTO {SUMMARY_TABLE} (dimension, key, {', '.join(SUMMARY_COLUMNS)}) "
+        f"SELECT '{dimension}', {_key(dimension, row)}, {', '.join(values)} WHERE {row}.deleted_at IS NULL "
+        f"ON CONFLICT (dimension, key) DO UPDATE SET {updates};"
+        for dimension in [TOTAL, *DIMENSIONS]
+    ]
+    if sign == "-":
+        # drop keys that no longer have any row (point deletes on the primary key)
+        statements += [
+            f"DELETE FROM {SUMMARY_TABLE} WHERE dimension = '{dimension}' "
+            f"AND key = {_key(dimension, row)} AND positions = 0;"
+            for dimension in DIMENSIONS
+        ]
+    return "\n".join(statements)
+
+
+def create_summary(conn, replace_triggers=False):
+    """
+    Create the summary table and its triggers. Does not commit.
+    replace_triggers drops existing triggers first, for changed definitions.
+    """
+    cur = conn.cursor()
+    if replace_triggers:
+        for trigger in SUMMARY_TRIGGERS:
+            cur.execute(f"DROP TRIGGER IF EXISTS {trigger};")
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {SUMMARY_TABLE} (
+            dimension TEXT NOT NULL,
+            key TEXT NOT NULL,
+            positions INTEGER NOT NULL DEFAULT 0,
+            stueck INTEGER NOT NULL DEFAULT 0,
+            netto_cent INTEGER NOT NULL DEFAULT 0,
+            brutto_cent INTEGER NOT NULL DEFAULT 0,
+            geliefert INTEGER NOT NULL DEFAULT 0,
+            uebergeben INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dimension, key)
+        ) WITHOUT ROWID
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS report_totals_ai AFTER INSERT ON inventory BEGIN
+            {_apply_sql("new", "+")}
+        END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS report_totals_ad AFTER DELETE ON inventory BEGIN
+            {_apply_sql("old", "-")}
+        END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS report_totals_au AFTER UPDATE OF {', '.join(TRACKED_COLUMNS)} ON inventory BEGIN
+            {_apply_sql("old", "-")}
+            {_apply_sql("new", "+")}
+        END
+    """)
+
+
+def rebuild_summary(conn):
+    """Recompute all totals from the inventory with one grouped query per dimension. Does not commit."""
+    conn.execute(f"DELETE FROM {SUMMARY_TABLE};")
+    values = _contribution("inventory")
+    sums = ", ".join(f"SUM({v})" for v in values)
+    for dimension in [TOTAL, *DIMENSIONS]:
+        key = _key(dimension, "inventory")
+        conn.execute(f"""
+            INSERT INTO {SUMMARY_TABLE} (dimension, key, {', '.join(SUMMARY_COLUMNS)})
+            SELECT '{dimension}', {key}, {sums} FROM inventory WHERE deleted_at IS NULL GROUP BY {key};
+        """)
+
+
+# -------------------- Reading --------------------
+
+def _row(key, positions, stueck, netto_cent, brutto_cent, geliefert, uebergeben):
+    return {
+        "key": key,
+        "positions": positions,
+        "stueck": stueck,
+        "netto": netto_cent / 100,
+        "brutto": brutto_cent / 100,
+        "geliefert": geliefert,
+        "uebergeben": uebergeben,
+        # delivered but not yet handed over / not even delivered
+        "offen": max(geliefert - uebergeben, 0),
+        "nicht_geliefert": max(stueck - geliefert, 0),
+    }
+
+
+def get_totals():
+    """Overall totals (all zero for an empty inventory)."""
+    row = database.get_connection().execute(
+        f"SELECT key, {', '.join(SUMMARY_COLUMNS)} FROM {SUMMARY_TABLE} WHERE dimension=?;",
+        (TOTAL,),
+    ).fetchone()
+    return _row(*(row or ("", 0, 0, 0, 0, 0, 0)))
+
+
+def get_report(dimension):
+    """Totals per value of one dimension, highest net sum first."""
+    if dimension not in DIMENSIONS:
+        raise ValueError(f"Unbekannte Auswertung: {dimension}")
+    rows = database.get_connection().execute(
+        f"SELECT key, {', '.join(SUMMARY_COLUMNS)} FROM {SUMMARY_TABLE} "
+        f"WHERE dimension=? ORDER BY netto_cent DESC, key;",
+        (dimension,),
+    ).fetchall()
+    report = [_row(*r) for r in rows]
+    if dimension == "kategorie":
+        for r in report:
+            r["key"] = CATEGORY_LABELS.get(r["key"], r["key"])
+    return report
+
+
+def get_reports():
+    """All dimensions for the /berichte page: {dimension: [rows]}."""
+    return {dimension: get_report(dimension) for dimension in DIMENSIONS}
@@ -1,21 +1,69 @@
 import sqlite3, hashlib
+import os
+import threading
+import time
 from core.database import get_connection
 
+# Users are cached per process for this many seconds. Writes through this
+# module invalidate the cache at once; other processes see them after the TTL.
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", 60))
+
+_cache_lock = threading.Lock()
+_user_cache = {}                # str(id) -> (loaded_at, (id, username, role))
+
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
+def _remember(user_id, username, role):
+    with _cache_lock:
+        _user_cache[str(user_id)] = (time.monotonic(), (user_id, username, role))
+
+def invalidate_user_cache(user_id=None):
+    """Drop one cached user, or all of them."""
+    with _cache_lock:
+        if user_id is None:
+            _user_cache.clear()
+        else:
+            _user_cache.pop(str(user_id), None)
+
+def get_user(user_id):
+    """(id, username, role) of a user, or None. Served from the cache while it is fresh."""
+    cached = _user_cache.get(str(user_id))
+    if cached and time.monotonic() - cached[0] < USER_CACHE_TTL:
+        return cached[1]
+
+    row = get_connection().execute(
+        "SELECT id, username, role FROM users WHERE id=?", (user_id,)
+    ).fetchone()
+    if row is None:
+        invalidate_user_cache(user_id)
+        return None
+    _remember(*row)
+    return tuple(row)
+
 def add_user(username, password, role="user"):
     conn = get_connection()
     cur = conn.cursor()
     cur.execute("INSERT OR IGNORE INTO users (username, password_hash, role) VALUES (?, ?, ?)",
                 (username, hash_password(password), role))
     conn.commit()
-    conn.close()
+    invalidate_user_cache()
+
+def set_user_role(username, role):
+    """Change a user's role. Returns False if there is no such user."""
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("UPDATE users SET role=? WHERE username=?", (role, username))
+    conn.commit()
+    invalidate_user_cache()
+    return cur.rowcount > 0
 
 def verify_user(username, password):
     conn = get_connection()
     cur = conn.cursor()
     cur.execute("SELECT * FROM users WHERE username=? AND password_hash=?", (username, hash_password(password)))
     user = cur.fetchone()
-    conn.close()
+    if user:
+        # the requests after the login load the user from the cache
+        _remember(user[0], user[1], user[3])
     return user
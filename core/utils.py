@@ -1,32 +1,39 @@
 import datetime
 from . import database
 
-def generate_code(abbr: str, purchase_date: str) -> str:
-    """
-    Generate LL-ABR-YYMM-#### style code.
-    YYMM comes from purchase_date (yyyy-mm-dd),
-    counter resets per Gemeinde+month.
-    """
-    # parse purchase_date -> YYMM
+def _year_month(purchase_date: str) -> str:
+    """YYMM from purchase_date (yyyy-mm-dd), today if missing or invalid."""
     try:
         dt = datetime.datetime.strptime(purchase_date, "%Y-%m-%d")
     except Exception:
         dt = datetime.date.today()
-        print('DATE TODAY: ', dt)
-    year_month = dt.strftime("%y%m")
+    return dt.strftime("%y%m")
+
 
-    # count existing codes for this Gemeinde and month
-    conn = database.get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT COUNT(*) FROM inventory WHERE code LIKE ?",
-        (f"LL-{abbr.upper()}-{year_month}-%",),
-    )
-    count = cur.fetchone()[0]
-    conn.close()
+def reserve_codes(abbr: str, purchase_date: str, count: int) -> list:
+    """
+    Reserve `count` consecutive LL-ABR-YYMM-#### codes with a single counter update.
+    The counter lives in the code_sequences table and is only ever increased,
+    so deleted codes are never handed out again. The reservation belongs to
+    the caller's open transaction (commit it together with the inserts).
+    """
+    abbr = abbr.upper()
+    year_month = _year_month(purchase_date)
+    last = database.reserve_sequence(abbr, year_month, count)
+    return [format_code(abbr, year_month, seq) for seq in range(last - count + 1, last + 1)]
 
-    seq = count + 1
-    return f"LL-{abbr.upper()}-{year_month}-{seq:04d}"
+
+def format_code(abbr: str, year_month: str, seq: int) -> str:
+    return f"LL-{abbr}-{year_month}-{seq:04d}"
+
+
+def generate_code(abbr: str, purchase_date: str) -> str:
+    """
+    Generate LL-ABR-YYMM-#### style code.
+    YYMM comes from purchase_date (yyyy-mm-dd),
+    counter resets per Gemeinde+month.
+    """
+    return reserve_codes(abbr, purchase_date, 1)[0]
 
 
 
@@ -62,3 +69,29 @@ def calculate_prices(preis_netto, preis_brutto, mwst_satz):
         preis_netto = round(preis_brutto / (1 + mwst), 2)
 
     return preis_netto, preis_brutto
+
+
+def assign_category_series(preis_netto, is_verbrauch=None):
+    """
+    Vectorized assign_category for a pandas Series of net prices
+    (missing prices count as 0, like assign_category(netto or 0)).
+    """
+    netto = preis_netto.fillna(0)
+    category = 3 - (netto >= 50).astype(int) - (netto > 1000).astype(int)
+    if is_verbrauch is not None:
+        category = category.where(~is_verbrauch.fillna(False).astype(bool), 4)
+    return category
+
+
+def calculate_prices_series(preis_netto, preis_brutto, mwst_satz):
+    """
+    Vectorized calculate_prices for pandas Series, same rules row by row.
+    Returns (netto, brutto) Series.
+    """
+    mwst = mwst_satz.fillna(0) / 100
+    netto_missing = preis_netto.isna() | (preis_netto == 0)
+    brutto_missing = preis_brutto.isna() | (preis_brutto == 0)
+
+    brutto = preis_brutto.mask(~netto_missing & brutto_missing, (preis_netto * (1 + mwst)).round(2))
+    netto = preis_netto.mask(~brutto_missing & netto_missing, (preis_brutto / (1 + mwst)).round(2))
+    return netto, brutto